@@ -0,0 +1,290 @@
+import copy
+import gc
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import server
+
+
+# ---------------------------------------------------
+# SYNTHETIC SONG – כמו ה-JSON של music.ai, באורך נתון
+# ---------------------------------------------------
+CHORD_NAMES = ["C", "Am7", "F", "G7", "Bb", "D#m7", "E/G#", "F#m7b5", "Cmaj7", "Ebdim"]
+
+
+def make_song(bars, beats_per_bar=4, seconds_per_beat=0.5):
+    beats = []
+    chords = []
+    t = 0.0
+
+    for bar in range(bars):
+        bar_start = t
+        for beat in range(beats_per_bar):
+            beats.append({"time": t, "beatNum": beat + 1})
+            t += seconds_per_beat
+
+        half = beats_per_bar // 2
+        for i, (start_beat, end_beat) in enumerate(((1, half), (half + 1, beats_per_bar))):
+            name = CHORD_NAMES[(bar * 2 + i) % len(CHORD_NAMES)]
+            start = bar_start + (start_beat - 1) * seconds_per_beat
+            chords.append({
+                "chord_complex_pop": name,
+                "start_bar": bar + 1,
+                "start_beat": start_beat,
+                "end_bar": bar + 1,
+                "end_beat": end_beat,
+                "start": start,
+                "end": start + (end_beat - start_beat + 1) * seconds_per_beat
+            })
+
+    sections = [
+        {"start": i * 16 * beats_per_bar * seconds_per_beat, "label": f"Part {i}"}
+        for i in range(bars // 16 + 1)
+    ]
+
+    return chords, beats, sections
+
+
+def best_of(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# ---------------------------------------------------
+# MUSICXML RENDER – הזמן צריך לגדול לינארית עם מספר התיבות
+# ---------------------------------------------------
+def bench_musicxml_scaling(sizes=(250, 500, 1000, 2000, 4000), tolerance=2.5):
+    print("chords_to_musicxml: render time vs. song length")
+
+    per_bar = []
+    for bars in sizes:
+        chords, beats, sections = make_song(bars)
+        mapped_sections = server.map_sections_to_bars(sections, beats)
+
+        def render():
+            segments = server.build_segments(chords)
+            for s in segments:
+                s.start_bar -= 1
+                s.end_bar -= 1
+            server.chords_to_musicxml(segments, mapped_sections, 120.0, beats, key_str="C major")
+
+        elapsed = best_of(render)
+        per_bar.append(elapsed / bars)
+        print(f"  {bars:6d} bars  {elapsed * 1000:9.1f} ms  {elapsed / bars * 1e6:7.1f} us/bar")
+
+    growth = per_bar[-1] / per_bar[0]
+    linear = growth <= tolerance
+    print(f"  per-bar cost grew x{growth:.2f} from {sizes[0]} to {sizes[-1]} bars -> {'linear' if linear else 'SUPERLINEAR'}")
+    return linear
+
+
+# ---------------------------------------------------
+# CHORD PARSER – cache לפי (symbol, prefer_flats) מול פענוח מלא בכל קריאה
+# ---------------------------------------------------
+def bench_chord_parser(occurrences=50000):
+    print("chord parser: cached table vs. parsing every occurrence")
+
+    symbols = [CHORD_NAMES[i % len(CHORD_NAMES)] + ("/E" if i % 7 == 0 else "") for i in range(occurrences)]
+
+    def uncached():
+        for symbol in symbols:
+            server.parse_chord_for_xml(server.normalize_chord_spelling(symbol, True))
+
+    def cached():
+        for symbol in symbols:
+            server.parse_chord_symbol(symbol, True)
+
+    server.parse_chord_symbol.cache_clear()
+    slow = best_of(uncached)
+    fast = best_of(cached)
+    stats = server.chord_cache_stats()
+
+    print(f"  {occurrences} chords, {stats['entries']} distinct symbols")
+    print(f"  uncached {slow * 1000:8.1f} ms  ({slow / occurrences * 1e9:6.0f} ns/chord)")
+    print(f"  cached   {fast * 1000:8.1f} ms  ({fast / occurrences * 1e9:6.0f} ns/chord)  x{slow / fast:.1f}")
+    print(f"  hit ratio {stats['hit_ratio']:.4f} ({stats['hits']} hits / {stats['misses']} misses)")
+
+
+# ---------------------------------------------------
+# MUSICXML STREAMING – זיכרון שיא ו-time-to-first-byte
+# ---------------------------------------------------
+def bench_musicxml_streaming(bars=4000):
+    print(f"iter_musicxml vs. buffered chords_to_musicxml ({bars} bars)")
+
+    chords, beats, sections = make_song(bars)
+    grid = server.BeatGrid(beats)
+    mapped_sections = server.map_sections_to_bars(sections, grid)
+
+    def segments():
+        segs = server.build_segments(chords)
+        for s in segs:
+            s.start_bar -= 1
+            s.end_bar -= 1
+        return segs
+
+    def buffered():
+        return server.chords_to_musicxml(segments(), mapped_sections, 120.0, grid, key_str="C major")
+
+    def streamed():
+        first = None
+        size = 0
+        started = time.perf_counter()
+        for chunk in server.iter_musicxml(segments(), mapped_sections, 120.0, grid, key_str="C major"):
+            if first is None:
+                first = time.perf_counter() - started
+            size += len(chunk)
+        return first, size
+
+    for name, fn in (("buffered", buffered), ("streamed", streamed)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = fn()
+        total = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        ttfb = result[0] if name == "streamed" else total
+        print(f"  {name:8s}  peak {peak / 1024:8.0f} KiB  first byte {ttfb * 1000:7.2f} ms  total {total * 1000:7.1f} ms")
+
+
+# ---------------------------------------------------
+# /status LAYOUT – rows (dict לכל beat) מול columnar
+# ---------------------------------------------------
+def bench_status_layout(bars=4000):
+    print(f"/status beats + timeline payload: rows vs. columnar ({bars} bars, bpm_override applied)")
+
+    # זמנים "אמיתיים" עם הרבה ספרות, כמו ב-JSON של music.ai
+    chords, beats, _ = make_song(bars, seconds_per_beat=0.4643990929705215)
+    scale = server.bpm_scale(129.2, 120)
+
+    def rows():
+        grid = server.BeatGrid(beats).rescaled(scale)
+        payload = {
+            "beats": server.scale_rows(beats, "time", grid.times),
+            "timeline_chords": server.scale_timeline(server.build_timeline_segments(chords), scale)
+        }
+        return json.dumps(payload, separators=(",", ":"), default=server.json_default)
+
+    def columnar():
+        grid = server.BeatGrid(beats).rescaled(scale)
+        payload = {
+            "beats": server.beat_columns(grid),
+            "timeline_chords": server.timeline_columns(server.scale_timeline(server.build_timeline_segments(chords), scale))
+        }
+        return json.dumps(payload, separators=(",", ":"), default=server.json_default)
+
+    for name, fn in (("rows", rows), ("columnar", columnar)):
+        elapsed = best_of(fn)
+        size = len(fn())
+        print(f"  {name:8s}  {elapsed * 1000:7.1f} ms  {size / 1024:8.1f} KiB")
+
+
+# ---------------------------------------------------
+# BPM SCALING – לולאה במקום על כל dict (כמו פעם) מול הנתיב של ChartIR:
+# BeatGrid.rescaled + scale_timeline (ה-grid וה-timeline נבנים פעם אחת, מחוץ למדידה)
+# ---------------------------------------------------
+def bench_bpm_scaling(bars=8000):
+    print(f"bpm scaling: in-place dict loop vs. BeatGrid.rescaled + scale_timeline ({bars} bars)")
+
+    chords, beats, _ = make_song(bars, seconds_per_beat=0.4643990929705215)
+    scale = server.bpm_scale(129.2, 120)
+
+    def in_place():
+        # הגרסה הישנה משנה את ה-dicts – כל ריצה על עותק, ההעתקה לא נמדדת
+        b, c = copy.deepcopy(beats), copy.deepcopy(chords)
+        started = time.perf_counter()
+        for row in b:
+            if row.get("time") is not None:
+                row["time"] = row["time"] / scale
+        for row in c:
+            if row.get("start") is not None:
+                row["start"] = row["start"] / scale
+            if row.get("end") is not None:
+                row["end"] = row["end"] / scale
+        return time.perf_counter() - started
+
+    grid = server.BeatGrid(beats)
+    timeline = server.build_timeline_segments(chords)
+
+    slow = min(in_place() for _ in range(3))
+    fast = best_of(lambda: (grid.rescaled(scale), server.scale_timeline(timeline, scale)))
+
+    print(f"  in-place  {slow * 1000:7.1f} ms")
+    print(f"  chart-ir  {fast * 1000:7.1f} ms  (x{fast / slow:.2f}, originals untouched)")
+
+
+# ---------------------------------------------------
+# MEMORY – peak RSS של בקשה אחת (ChartIR + /status JSON + MusicXML), כל מדידה בתהליך נפרד
+# ---------------------------------------------------
+# להשוואה מול גרסה קודמת: git show <rev>:server.py > /tmp/server_before.py
+# BENCH_BASELINE=/tmp/server_before.py python bench.py memory   (כל גרסה שיש בה ChartIR)
+def request_peak_rss(module_path, bars):
+    spec = importlib.util.spec_from_file_location("server_under_test", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    chords, beats, sections = make_song(bars, seconds_per_beat=0.4643990929705215)
+    analysis = (chords, sections, beats, 129.2, None, "Eb major", "Bench", None, None, None, "SUCCEEDED")
+
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    ir = module.ChartIR("bench", analysis)
+    status_size = len(module.app.json.dumps(module.render_status_json(ir)))
+    xml_size = sum(map(len, module.render_musicxml(ir.bars, ir.bpm, ir.key_fifths, ir.key_mode)))
+
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss ב-KiB (Linux)
+    return {"peak_kib": after - before, "status_bytes": status_size, "xml_bytes": xml_size}
+
+
+def bench_memory(sizes=(2000, 8000, 32000)):
+    print("per-request peak RSS (ChartIR + /status JSON + MusicXML)")
+
+    variants = [("current", os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"))]
+    if os.environ.get("BENCH_BASELINE"):
+        variants.insert(0, ("baseline", os.environ["BENCH_BASELINE"]))
+
+    for bars in sizes:
+        for name, path in variants:
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--rss", path, str(bars)],
+                capture_output=True, text=True, check=True
+            )
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"  {bars:6d} bars  {name:8s}  peak +{result['peak_kib'] / 1024:7.1f} MiB")
+
+
+BENCHMARKS = {
+    "musicxml": bench_musicxml_scaling,
+    "chords": bench_chord_parser,
+    "streaming": bench_musicxml_streaming,
+    "layout": bench_status_layout,
+    "scaling": bench_bpm_scaling,
+    "memory": bench_memory,
+}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--rss"]:
+        print(json.dumps(request_peak_rss(sys.argv[2], int(sys.argv[3]))))
+        sys.exit(0)
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+    ok = True
+    for name in names:
+        ok = BENCHMARKS[name]() is not False and ok
+        print()
+    sys.exit(0 if ok else 1)
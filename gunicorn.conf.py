@@ -0,0 +1,16 @@
+import os
+
+# gunicorn טוען את הקובץ הזה אוטומטית מהתיקייה הנוכחית: gunicorn server:app
+# bind / workers – לפי PORT ו-WEB_CONCURRENCY כמו בברירת המחדל של gunicorn
+
+# ---------------------------------------------------
+# WORKER – gevent: כל בקשה היא greenlet ולא thread
+# ---------------------------------------------------
+# צופי long-poll (/status?wait=) ו-SSE (/status/<job_id>/events) מחכים על ה-Condition
+# של ה-poller בלי לתפוס thread – מאות צופים פתוחים לכל worker.
+# ה-worker עושה monkey-patch לפני טעינת server.py, לכן אין preload_app.
+worker_class = "gevent"
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+
+# ב-gevent ה-timeout הוא heartbeat של ה-worker, לא משך בקשה – SSE נשאר פתוח עד SSE_MAX_DURATION
+timeout = int(os.environ.get("WORKER_TIMEOUT", 30))
@@ -1,112 +1,741 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import re
+import copy
+import json
+import threading
+import time
+import logging
+import math
+import tempfile
+import uuid
+import hashlib
+import atexit
+import cProfile
+import hmac
+import pstats
+import random
+import sqlite3
+import zipfile
+import zlib
+from io import BytesIO, StringIO
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import cached_property, lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from itertools import chain, repeat
+from operator import attrgetter, mul, sub
 from xml.etree.ElementTree import Element, SubElement, tostring
 
 app = Flask(__name__)
 CORS(app)
 
+log = logging.getLogger("my-chart")
+
 API_KEY = os.environ.get("API_KEY")
 WORKFLOW = "my-chart-recognizer"
 
+MUSIC_AI_URL = os.environ.get("MUSIC_AI_URL", "https://api.music.ai")
+
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 16))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 30))
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 3))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", 0.3))
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 256 * 1024))
+
+SPOOL_DIR = os.environ.get("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "my-chart-spool"))
+SUBMIT_WORKERS = int(os.environ.get("SUBMIT_WORKERS", 2))
+SUBMIT_QUEUE_SIZE = int(os.environ.get("SUBMIT_QUEUE_SIZE", 32))
+TICKET_TTL = float(os.environ.get("TICKET_TTL", 24 * 60 * 60))
+
+DATA_DIR = os.environ.get("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", 100000))
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", 30 * 24 * 60 * 60))
+
+ARTIFACT_FETCH_CONCURRENCY = int(os.environ.get("ARTIFACT_FETCH_CONCURRENCY", 8))
+ARTIFACT_TIMEOUT = float(os.environ.get("ARTIFACT_TIMEOUT", 20))
+
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", 2))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", 30))
+POLL_BACKOFF = float(os.environ.get("POLL_BACKOFF", 1.5))
+POLL_MAX_AGE = float(os.environ.get("POLL_MAX_AGE", 2 * 60 * 60))
+POLL_MAX_JOBS = int(os.environ.get("POLL_MAX_JOBS", 1000))
+STATUS_FRESH_SECONDS = float(os.environ.get("STATUS_FRESH_SECONDS", 2))
+
+TERMINAL_STATES = ("SUCCEEDED", "FAILED")
+
+LONGPOLL_MAX_WAIT = float(os.environ.get("LONGPOLL_MAX_WAIT", 30))
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", 15))
+SSE_MAX_DURATION = float(os.environ.get("SSE_MAX_DURATION", 30 * 60))
+
+CHORD_CACHE_SIZE = int(os.environ.get("CHORD_CACHE_SIZE", 4096))
+
+# לשנות בכל פעם שהפלט של /status או /musicxml משתנה – מבטל ETags ישנים
+RENDERER_VERSION = "1"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+STORE_MAX_BYTES = int(os.environ.get("STORE_MAX_BYTES", 512 * 1024 * 1024))
+# לשנות כשהמבנה של הנתונים הנגזרים (segments / timeline) משתנה
+STORE_SCHEMA_VERSION = 1
+
+ANALYZE_CONCURRENCY = int(os.environ.get("ANALYZE_CONCURRENCY", 4))
+ANALYZE_MAX_FILES = int(os.environ.get("ANALYZE_MAX_FILES", 50))
+
+BARS_PAGE_SIZE = int(os.environ.get("BARS_PAGE_SIZE", 16))
+BARS_PAGE_MAX = int(os.environ.get("BARS_PAGE_MAX", 500))
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", 100))
+
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 6 * 60 * 60))
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(DATA_DIR, "metrics"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+METRICS_RETIRED_DB = "metrics-retired.sqlite3"
+METRICS_RETIRED_KEEP = 24 * 60 * 60
+
+# profiling – כבוי כברירת מחדל. PROFILE_TOKEN: header ‏X-Profile-Token מפעיל פרופיל לבקשה
+# ונדרש גם ל-/profiles; PROFILE_SAMPLE_RATE: חלק מהבקשות (0–1) שנדגמות אוטומטית
+# פרופיל אחד בכל פעם לכל worker – בקשות שמגיעות בזמן פרופיל פעיל לא נמדדות
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 50))
+
+
+# ---------------------------------------------------
+# METRICS – בזיכרון של כל worker, נכתב לקובץ לפי pid; /metrics מאחד את כל הקבצים
+# ---------------------------------------------------
+# קובץ של worker מת מקופל לרשומה מצטברת אחת ב-SQLite (METRICS_RETIRED_DB) ונמחק,
+# כך ש-/metrics קורא רק קבצים של workers חיים + שורה לכל סדרה.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name -> (type, help, buckets)
+METRIC_TYPES = {
+    "http_request_seconds": ("histogram", "Request latency by route", LATENCY_BUCKETS),
+    "response_bytes": ("histogram", "Response body size as sent (after compression) by route", SIZE_BUCKETS),
+    "upstream_request_seconds": ("histogram", "music.ai request latency by call type", LATENCY_BUCKETS),
+    "pipeline_seconds": ("histogram", "Time spent in each pipeline stage", LATENCY_BUCKETS),
+    "upstream_in_flight": ("gauge", "music.ai requests currently in flight", None),
+    "cache_hits_total": ("counter", "Cache hits", None),
+    "cache_misses_total": ("counter", "Cache misses", None),
+}
+
+METRIC_PREFIX = "my_chart_"
+
+
+class Metrics:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.collectors = []
+        self._reset()
+        # אין fork ב-Windows (שרת פיתוח, תהליך אחד)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # אחרי fork (gunicorn) – מתחילים מאפס, עם קובץ ו-thread משלנו.
+        # instance מזהה את התהליך גם כשה-pid שלו ימוחזר אחרי שימות
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._values = {}
+        self._thread = None
+        self._claimed = False
+        self._db_ready = False
+        self.instance = uuid.uuid4().hex
+
+    def start(self):
+        # thread נפתח מתוך בקשה (אחרי fork של gunicorn), לא מתוך observe
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def observe(self, name, value, labels=()):
+        # labels = tuple של (key, value) – נבנה פעם אחת אצל הקורא
+        buckets = METRIC_TYPES[name][2]
+        i = bisect_left(buckets, value)
+        key = (name, labels)
+
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                # ספירה לכל bucket (לא מצטברת), +Inf, ואז sum
+                h = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += value
+
+    def add(self, name, amount, labels=()):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def timed(self, stage):
+        # decorator: זמן הריצה של הפונקציה ב-pipeline_seconds{stage=...}
+        labels = (("stage", stage),)
+
+        def decorate(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe("pipeline_seconds", time.perf_counter() - started, labels)
+            return wrapper
+
+        return decorate
+
+    def timed_stream(self, stage, chunks):
+        # generator: רק הזמן שבתוך ה-generator הפנימי נספר, לא ההמתנה ללקוח
+        labels = (("stage", stage),)
+        elapsed = 0.0
+        chunks = iter(chunks)
+
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    elapsed += time.perf_counter() - started
+                    break
+                elapsed += time.perf_counter() - started
+                yield chunk
+        finally:
+            self.observe("pipeline_seconds", elapsed, labels)
+
+    def path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def flush(self):
+        # counters של caches וכו' – ערך מצטבר של התהליך, נקרא רק בזמן flush
+        values = {}
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    values[(name, labels)] = value
+            except Exception as e:
+                log.warning("metrics collector failed: %s", e)
+
+        with self._lock:
+            values.update(self._values)
+            record = {
+                "instance": self.instance,
+                "histograms": [[name, labels, h] for (name, labels), h in self._histograms.items()],
+                "values": [[name, labels, v] for (name, labels), v in values.items()]
+            }
+
+        pid = os.getpid()
+
+        # קובץ עם ה-pid שלנו שלא אנחנו כתבנו – של worker מת שה-pid שלו מוחזר; מקפלים לפני שדורסים
+        if not self._claimed:
+            self._claimed = True
+            previous = read_metrics_file(self.path(pid))
+            if previous is not None and previous.get("instance") != self.instance:
+                self.retire_safely(self.path(pid), previous.get("instance"))
+
+        tmp_path = self.path(pid) + ".tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(record, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path(pid))
+        except OSError as e:
+            log.warning("metrics flush failed: %s", e)
+
+    def collect(self):
+        # סכום של הרשומה המצטברת של workers מתים + הקבצים של החיים.
+        # gauges רק של workers חיים; counters / histograms גם של מתים (מונוטוני)
+        self.flush()
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+
+        # קודם הקבצים ואז ה-DB: worker שקופל בינתיים כבר מופיע ב-DB, ומדלגים על הקובץ שלו
+        records = []
+        for file_name in names:
+            match = METRICS_FILE_RE.match(file_name)
+            if not match:
+                continue
+
+            path = os.path.join(self.directory, file_name)
+            record = read_metrics_file(path)
+            if record is not None:
+                records.append((int(match.group(1)), path, record))
+
+        try:
+            series, retired = self.retired()
+        except sqlite3.Error as e:
+            log.warning("reading retired metrics failed: %s", e)
+            series, retired = [], None
+
+        histograms = {}
+        values = {}
+
+        for name, labels, data in series:
+            key = (name, tuple(map(tuple, json.loads(labels))))
+            data = json.loads(data)
+            if isinstance(data, list):
+                histograms[key] = data
+            else:
+                values[key] = data
+
+        dead = []
+
+        for pid, path, record in records:
+            instance = record.get("instance")
+
+            # קובץ שנשאר אחרי קיפול (נפל לפני המחיקה) – כבר בתוך series
+            if retired is not None and instance in retired:
+                dead.append((path, instance))
+                continue
+
+            alive = pid_alive(pid)
+            if not alive and retired is not None:
+                dead.append((path, instance))
+
+            for name, labels, h in record["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.get(key)
+                histograms[key] = h if total is None else list(map(sum, zip(total, h)))
+
+            for name, labels, value in record["values"]:
+                if name not in METRIC_TYPES:
+                    continue
+                if METRIC_TYPES[name][0] == "gauge" and not alive:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                values[key] = values.get(key, 0) + value
+
+        # נספרו כבר בסריקה הזו מהקובץ; מהסריקה הבאה – מה-DB
+        for path, instance in dead:
+            self.retire_safely(path, instance)
+
+        return histograms, values
+
+    @contextmanager
+    def _retired_db(self):
+        with open_db(METRICS_RETIRED_DB, self.directory) as conn:
+            if not self._db_ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS retired_series ("
+                    "name TEXT NOT NULL, labels TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (name, labels))"
+                )
+                conn.execute("CREATE TABLE IF NOT EXISTS retired_workers (instance TEXT PRIMARY KEY, retired REAL NOT NULL)")
+                self._db_ready = True
+            yield conn
+
+    def retired(self):
+        # (series, instances שקופלו) מאותו snapshot
+        with self._retired_db() as conn:
+            conn.execute("BEGIN")
+            series = conn.execute("SELECT name, labels, data FROM retired_series").fetchall()
+            instances = {row[0] for row in conn.execute("SELECT instance FROM retired_workers")}
+            conn.execute("COMMIT")
+        return series, instances
+
+    def retire(self, path, instance):
+        # מקפל את הקובץ של worker מת לתוך retired_series ומוחק אותו.
+        # BEGIN IMMEDIATE – worker אחד בכל פעם; הקובץ נקרא שוב בתוך הנעילה.
+        # exception באמצע → open_db עושה rollback
+        with self._retired_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+
+            record = read_metrics_file(path)
+            current = record is not None and record.get("instance") == instance
+
+            known = conn.execute("SELECT 1 FROM retired_workers WHERE instance = ?", (instance,)).fetchone()
+
+            if current and not known:
+                for name, labels, h in record["histograms"]:
+                    self._merge_retired(conn, name, labels, h)
+                for name, labels, value in record["values"]:
+                    if METRIC_TYPES.get(name, ("gauge",))[0] != "gauge":
+                        self._merge_retired(conn, name, labels, value)
+
+                now = time.time()
+                conn.execute("INSERT OR REPLACE INTO retired_workers VALUES (?, ?)", (instance, now))
+                conn.execute("DELETE FROM retired_workers WHERE retired < ?", (now - METRICS_RETIRED_KEEP,))
+
+            conn.execute("COMMIT")
+
+        # אם הקובץ כבר הוחלף (pid מוחזר) הוא לא שלנו למחוק
+        if current:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def retire_safely(self, path, instance):
+        try:
+            self.retire(path, instance)
+        except sqlite3.Error as e:
+            log.warning("retiring metrics file %s failed: %s", path, e)
+
+    @staticmethod
+    def _merge_retired(conn, name, labels, data):
+        key = json.dumps(labels, separators=(",", ":"))
+        row = conn.execute("SELECT data FROM retired_series WHERE name = ? AND labels = ?", (name, key)).fetchone()
+
+        if row is not None:
+            total = json.loads(row[0])
+            data = list(map(sum, zip(total, data))) if isinstance(data, list) else total + data
+
+        conn.execute("INSERT OR REPLACE INTO retired_series VALUES (?, ?, ?)", (name, key, json.dumps(data)))
+
+    def render(self):
+        histograms, values = self.collect()
+        lines = []
+
+        for name, (kind, help_text, buckets) in METRIC_TYPES.items():
+            full_name = METRIC_PREFIX + name
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+
+            if kind == "histogram":
+                for (metric, labels), h in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), h):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {h[-1]}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {cumulative}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{full_name}{format_labels(labels)} {value}")
+
+        # hit ratio לכל cache – מחושב מה-counters המאוחדים
+        full_name = METRIC_PREFIX + "cache_hit_ratio"
+        lines.append(f"# HELP {full_name} Cache hit ratio across all workers")
+        lines.append(f"# TYPE {full_name} gauge")
+        for (metric, labels), hits in sorted(values.items()):
+            if metric != "cache_hits_total":
+                continue
+            lookups = hits + values.get(("cache_misses_total", labels), 0)
+            if lookups:
+                lines.append(f"{full_name}{format_labels(labels)} {hits / lookups}")
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS_FILE_RE = re.compile(r"^metrics-(\d+)\.json$")
+
+
+def read_metrics_file(path):
+    # None אם הקובץ חסר או באמצע כתיבה
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def pid_alive(pid):
+    # ב-Windows os.kill(pid, 0) שולח CTRL_C_EVENT – שם יש רק תהליך אחד, הקבצים האחרים מריצות קודמות
+    if os.name != "posix":
+        return pid == os.getpid()
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+metrics = Metrics(METRICS_DIR)
+atexit.register(metrics.flush)
+
+
+@app.before_request
+def start_request_timer():
+    if metrics._thread is None:
+        metrics.start()
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # רץ אחרון מבין ה-after_request (נרשם ראשון) – רואה את הגוף אחרי דחיסה
+    started = g.get("request_started")
+    if started is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    labels = (("route", route),)
+
+    def record(size):
+        metrics.observe("http_request_seconds", time.perf_counter() - started, labels + (("code", str(response.status_code)),))
+        metrics.observe("response_bytes", size, labels)
+
+    if response.is_streamed:
+        response.response = counted_stream(response.response, record)
+    else:
+        record(response.calculate_content_length() or 0)
+
+    return response
+
+
+def counted_stream(chunks, record):
+    # stream – הזמן והגודל נרשמים כשהלקוח קיבל הכל (או התנתק)
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        record(size)
+
+
+# ---------------------------------------------------
+# UPSTREAM HTTP CLIENT – session אחד עם keep-alive לכל התעבורה ל-music.ai
+# ---------------------------------------------------
+def make_upstream_session():
+    # retry רק ל-GET (idempotent); PUT/POST נשלחים פעם אחת
+    retry = Retry(
+        total=UPSTREAM_RETRIES,
+        backoff_factor=UPSTREAM_BACKOFF,
+        backoff_jitter=UPSTREAM_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=UPSTREAM_POOL_SIZE,
+        pool_maxsize=UPSTREAM_POOL_SIZE,
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+upstream = make_upstream_session()
+
+
+def upstream_request(method, url, call="other", **kwargs):
+    # call = סוג הקריאה (upload_url, upload, job_create, job_status, artifact_*) – label במטריקות
+    kwargs.setdefault("timeout", (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+
+    call_labels = (("call", call),)
+    metrics.add("upstream_in_flight", 1, call_labels)
+    started = time.perf_counter()
+    outcome = "error"
+
+    try:
+        res = upstream.request(method, url, **kwargs)
+        outcome = f"{res.status_code // 100}xx"
+        return res
+    finally:
+        metrics.add("upstream_in_flight", -1, call_labels)
+        metrics.observe("upstream_request_seconds", time.perf_counter() - started, call_labels + (("outcome", outcome),))
+
+
+def upstream_get(url, **kwargs):
+    return upstream_request("GET", url, **kwargs)
+
+
+def upstream_put(url, **kwargs):
+    return upstream_request("PUT", url, **kwargs)
+
+
+def upstream_post(url, **kwargs):
+    return upstream_request("POST", url, **kwargs)
+
 
 # ---------------------------------------------------
 # BPM SCALING
 # ---------------------------------------------------
-def apply_bpm_scaling(beats, chords, detected_bpm, manual_bpm):
+def bpm_scale(detected_bpm, manual_bpm):
     try:
         detected_bpm = float(detected_bpm)
         manual_bpm = float(manual_bpm)
     except:
-        return beats, chords
+        return None
 
     if detected_bpm <= 0 or manual_bpm <= 0:
-        return beats, chords
+        return None
 
+    # inf / 1e309 נותנים scale של 0 או inf – אין מה להקטין
     scale = detected_bpm / manual_bpm
+    if not math.isfinite(scale) or scale <= 0:
+        return None
+
+    return scale
+
+
+def scale_times(values, scale):
+    # array('d') חדש – הערכים המקוריים (משותפים) לא משתנים
+    return array("d", [t / scale for t in values])
 
-    # scale beats
-    if beats:
-        for b in beats:
-            if "time" in b and b["time"] is not None:
-                b["time"] = b["time"] / scale
 
-    # scale chords
-    if chords:
-        for c in chords:
-            if "start" in c and c["start"] is not None:
-                c["start"] = c["start"] / scale
-            if "end" in c and c["end"] is not None:
-                c["end"] = c["end"] / scale
+def scale_rows(rows, key, column):
+    # שורות ל-JSON (layout=rows) עם הערכים מהעמודה – כל שורה מועתקת פעם אחת,
+    # שורה בלי key נשארת המקור (המשותף) כמו שהוא
+    return [{**r, key: value} if r.get(key) is not None else r for r, value in zip(rows, column)]
 
-    return beats, chords
+
+def parse_bpm_override(value):
+    # ValueError אם הערך לא מספר חיובי סופי
+    if value is None or value == "":
+        return None
+
+    bpm = float(value)
+    if not math.isfinite(bpm) or not bpm > 0:
+        raise ValueError("bpm_override must be a positive number")
+
+    return bpm
 
 
 # ---------------------------------------------------
-# TIME SIGNATURE DETECTION (GLOBAL)
+# BEAT GRID – מעבר אחד על ה-beats, כל החישובים משתמשים בו
 # ---------------------------------------------------
-def detect_time_signature(beats):
-    if not beats:
-        return 4, 4
+class BeatGrid:
 
-    bar_lengths = []
-    current_count = 0
+    @metrics.timed("beat_grid")
+    def __init__(self, beats):
+        self.times = array("d")
+        self.beat_nums = array("l")
+        self.beat_bars = array("l")
 
-    for b in beats:
-        if b["beatNum"] == 1:
-            if current_count > 0:
-                bar_lengths.append(current_count)
-            current_count = 1
-        else:
-            current_count += 1
+        # bar index -> מספר beats. ‎-1 = אנקרוזה לפני ה-beat הראשון עם beatNum == 1
+        self.bar_counts = {}
+        self.bar_first_beat = {}
 
-    if current_count > 0:
-        bar_lengths.append(current_count)
+        bar_index = -1
+        ascending = True
 
-    if not bar_lengths:
-        return 4, 4
+        for i, b in enumerate(beats or ()):
+            if b["beatNum"] == 1:
+                bar_index += 1
 
-    # אם התיבה הראשונה קצרה משמעותית מהשאר → אנקרוזה
-    if len(bar_lengths) > 2:
-        if bar_lengths[0] < bar_lengths[1]:
-            bar_lengths = bar_lengths[1:]
+            if bar_index not in self.bar_counts:
+                self.bar_counts[bar_index] = 0
+                self.bar_first_beat[bar_index] = i
+            self.bar_counts[bar_index] += 1
 
-    # ניקח את הערך שמופיע הכי הרבה
-    from collections import Counter
-    most_common_length = Counter(bar_lengths).most_common(1)[0][0]
+            t = b.get("time")
+            t = float("nan") if t is None else float(t)
+            if self.times and not self.times[-1] <= t:
+                ascending = False
 
-    # עכשיו קובעים beat-type
-    if most_common_length in (6, 9, 12):
-        return most_common_length, 8
-    else:
-        return most_common_length, 4
+            self.times.append(t)
+            self.beat_nums.append(b["beatNum"])
+            self.beat_bars.append(bar_index)
 
-# ---------------------------------------------------
-# TIME SIGNATURE PER BAR
-# ---------------------------------------------------
-def detect_time_signature_per_bar(beats):
-    if not beats:
-        return {}
+        self.ascending = ascending
+        self.meter = self._detect_meter()
+
+    @metrics.timed("bpm_scaling")
+    def rescaled(self, scale):
+        # grid חדש עם זמנים מחולקים ב-scale; המבנה (bars/beats) משותף ולא משתנה
+        grid = copy.copy(self)
+        grid.times = scale_times(self.times, scale)
+        return grid
+
+    def __len__(self):
+        return len(self.times)
+
+    def _detect_meter(self):
+        bar_lengths = list(self.bar_counts.values())
 
-    bar_counts = {}
-    bar_index = -1
-    current_count = 0
+        if not bar_lengths:
+            return 4, 4
 
-    for b in beats:
-        if b["beatNum"] == 1:
-            if current_count > 0:
-                bar_counts[bar_index] = current_count
-            bar_index += 1
-            current_count = 1
+        # אם התיבה הראשונה קצרה משמעותית מהשאר → אנקרוזה
+        if len(bar_lengths) > 2:
+            if bar_lengths[0] < bar_lengths[1]:
+                bar_lengths = bar_lengths[1:]
+
+        # ניקח את הערך שמופיע הכי הרבה
+        most_common_length = Counter(bar_lengths).most_common(1)[0][0]
+
+        # עכשיו קובעים beat-type
+        if most_common_length in (6, 9, 12):
+            return most_common_length, 8
         else:
-            current_count += 1
+            return most_common_length, 4
+
+    def nearest_beat(self, t):
+        # ה-beat הקרוב ביותר בזמן; בשוויון – המוקדם (כמו min על הרשימה)
+        if not self.ascending:
+            return min(range(len(self.times)), key=lambda i: abs(self.times[i] - t))
+
+        i = bisect_left(self.times, t)
+        if i >= len(self.times):
+            i = len(self.times) - 1
+        elif i > 0 and abs(self.times[i - 1] - t) <= abs(self.times[i] - t):
+            i -= 1
+
+        return bisect_left(self.times, self.times[i])
+
+    def locate(self, t):
+        # (bar, beatNum) של ה-beat האחרון שמתחיל לפני t או בדיוק בו
+        i = max(bisect_right(self.times, t) - 1, 0)
+        return self.beat_bars[i], self.beat_nums[i]
+
+    def bar_at(self, t):
+        return self.beat_bars[self.nearest_beat(t)]
+
 
-    if current_count > 0:
-        bar_counts[bar_index] = current_count
+def as_beat_grid(beats):
+    return beats if isinstance(beats, BeatGrid) else BeatGrid(beats)
 
-    return bar_counts
+
+# ---------------------------------------------------
+# TIME SIGNATURE DETECTION (GLOBAL)
+# ---------------------------------------------------
+def detect_time_signature(beats):
+    return as_beat_grid(beats).meter
+
+
+# ---------------------------------------------------
+# TIME SIGNATURE PER BAR
+# ---------------------------------------------------
+def detect_time_signature_per_bar(beats):
+    return as_beat_grid(beats).bar_counts
 
 
 # ---------------------------------------------------
@@ -126,6 +755,9 @@ def pick_best_chord(c):
 # ---------------------------------------------------
 # CHORD PARSER FOR MUSICXML
 # ---------------------------------------------------
+CHORD_RE = re.compile(r"^([A-G])([#b]?)(.*)$")
+
+
 def parse_chord_for_xml(chord):
     try:
         original = chord
@@ -136,7 +768,7 @@ def parse_chord_for_xml(chord):
 
         chord = chord.replace("-", "m")
 
-        match = re.match(r"^([A-G])([#b]?)(.*)$", chord)
+        match = CHORD_RE.match(chord)
         if not match:
             return None
 
@@ -197,79 +829,175 @@ def parse_chord_for_xml(chord):
         return None
 
 
+# ---------------------------------------------------
+# CHART TYPES – אובייקטים עם __slots__ במקום dict לכל אקורד / section
+# ---------------------------------------------------
+# beats נשמרים ב-BeatGrid (מערכים). ב-JSON החוצה כל אובייקט הופך ל-dict (to_json) –
+# רק בזמן הסריאליזציה, לא בין השלבים
+class ChordSegment:
+    # start_sec לא מוגדר אם לאקורד אין "start" ב-JSON של music.ai
+    __slots__ = ("chord", "start_bar", "start_beat", "end_bar", "end_beat", "start_sec")
+
+    def __init__(self, chord, start_bar, start_beat, end_bar, end_beat):
+        self.chord = chord
+        self.start_bar = start_bar
+        self.start_beat = start_beat
+        self.end_bar = end_bar
+        self.end_beat = end_beat
+
+    def to_json(self):
+        out = {
+            "chord": self.chord,
+            "start_bar": self.start_bar,
+            "start_beat": self.start_beat,
+            "end_bar": self.end_bar,
+            "end_beat": self.end_beat,
+        }
+        if hasattr(self, "start_sec"):
+            out["start_sec"] = self.start_sec
+        return out
+
+    @classmethod
+    def from_json(cls, data):
+        seg = cls(data["chord"], data["start_bar"], data["start_beat"], data["end_bar"], data["end_beat"])
+        if "start_sec" in data:
+            seg.start_sec = data["start_sec"]
+        return seg
+
+
+class TimelineChord:
+    __slots__ = ("chord", "start", "end")
+
+    def __init__(self, chord, start, end):
+        self.chord = chord
+        self.start = start
+        self.end = end
+
+    def to_json(self):
+        return {"chord": self.chord, "start": self.start, "end": self.end}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["chord"], data["start"], data["end"])
+
+
+class SectionMark:
+    __slots__ = ("label", "start_bar")
+
+    def __init__(self, label, start_bar):
+        self.label = label
+        self.start_bar = start_bar
+
+    def to_json(self):
+        return {"label": self.label, "start_bar": self.start_bar}
+
+
+def json_default(value):
+    # json.dumps(default=...) – אובייקטי ה-chart לפי to_json, כל השאר כ-str
+    to_json = getattr(value, "to_json", None)
+    return to_json() if to_json is not None else str(value)
+
+
+class ChartJSONProvider(DefaultJSONProvider):
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (ChordSegment, TimelineChord, SectionMark)):
+            return o.to_json()
+        return DefaultJSONProvider.default(o)
+
+
+app.json = ChartJSONProvider(app)
+
+
 # ---------------------------------------------------
 # SEGMENTS – משתמשים בדיוק ב-bar/beat מה-JSON
 # ---------------------------------------------------
+def chord_symbol(c):
+    # האקורד (עם בס אם יש) של רשומה מה-JSON של music.ai, או None ל-"N" / ריק
+    chord = pick_best_chord(c)
+    if not chord:
+        return None
+
+    bass = c.get("bass")
+    if bass:
+        chord = f"{chord}/{bass}"
+
+    return chord
+
+
+@metrics.timed("build_segments")
 def build_segments(chords_list):
     segments = []
     for c in chords_list:
-        chord = pick_best_chord(c)
-        bass = c.get("bass")
+        chord = chord_symbol(c)
 
         if not chord:
             continue
 
-        if bass:
-            chord = f"{chord}/{bass}"
-
-        seg = {
-            "chord": chord,
-            "start_bar": c["start_bar"],
-            "start_beat": c["start_beat"],
-            "end_bar": c["end_bar"],
-            "end_beat": c["end_beat"],
-        }
+        seg = ChordSegment(chord, c["start_bar"], c["start_beat"], c["end_bar"], c["end_beat"])
 
         # נשמור גם זמן אם קיים, אבל לא נשתמש בו כדי לשנות bar/beat
         if "start" in c:
-            seg["start_sec"] = c["start"]
+            seg.start_sec = c["start"]
 
         segments.append(seg)
 
     return segments
 
 
+@metrics.timed("build_timeline_segments")
 def build_timeline_segments(chords_list):
     timeline = []
     for c in chords_list:
-        chord = pick_best_chord(c)
-        bass = c.get("bass")
+        chord = chord_symbol(c)
 
         if not chord:
             continue
 
-        if bass:
-            chord = f"{chord}/{bass}"
-
         start = c.get("start")
         end = c.get("end")
 
         if start is None or end is None:
             continue
 
-        timeline.append({
-            "chord": chord,
-            "start": start,
-            "end": end
-        })
+        timeline.append(TimelineChord(chord, start, end))
 
     return timeline
 
 
+@metrics.timed("bpm_scaling")
+def scale_timeline(timeline, scale):
+    # TimelineChord חדשים עם start / end מוקטנים; ה-timeline המקורי (משותף) לא משתנה
+    return [TimelineChord(c.chord, c.start / scale, c.end / scale) for c in timeline]
+
+
+@metrics.timed("bpm_scaling")
+def scale_segments(segments, scale):
+    # ChordSegment חדשים עם start_sec מוקטן – bar / beat לא תלויים ב-BPM
+    scaled = []
+    for s in segments:
+        seg = ChordSegment(s.chord, s.start_bar, s.start_beat, s.end_bar, s.end_beat)
+
+        if hasattr(s, "start_sec"):
+            seg.start_sec = None if s.start_sec is None else s.start_sec / scale
+
+        scaled.append(seg)
+
+    return scaled
+
+
 # ---------------------------------------------------
 # MAP SECTIONS TO BARS (אופציונלי, לפי beats)
 # ---------------------------------------------------
+@metrics.timed("map_sections_to_bars")
 def map_sections_to_bars(sections, beats):
     if not sections or not beats:
         return None
 
-    bar_index = -1
-    beat_to_bar = []
-
-    for b in beats:
-        if b["beatNum"] == 1:
-            bar_index += 1
-        beat_to_bar.append((b["time"], bar_index))
+    grid = as_beat_grid(beats)
+    if not len(grid):
+        return None
 
     mapped = []
 
@@ -278,18 +1006,14 @@ def map_sections_to_bars(sections, beats):
         if sec_start is None:
             continue
 
-        closest = min(beat_to_bar, key=lambda x: abs(x[0] - sec_start))
-        bar = closest[1]
+        bar = grid.bar_at(sec_start)
 
         label = sec.get("label") or "Section"
 
-        if mapped and mapped[-1]["label"] == label:
+        if mapped and mapped[-1].label == label:
             continue
 
-        mapped.append({
-            "label": label,
-            "start_bar": bar
-        })
+        mapped.append(SectionMark(label, bar))
 
     return mapped
 
@@ -351,84 +1075,212 @@ def parse_key_to_musicxml(key_str):
 
     return 0, "minor"
 
+SHARP_TO_FLAT = {
+    "A#": "Bb",
+    "C#": "Db",
+    "D#": "Eb",
+    "F#": "Gb",
+    "G#": "Ab",
+}
+
+FLAT_TO_SHARP = {
+    "Bb": "A#",
+    "Db": "C#",
+    "Eb": "D#",
+    "Gb": "F#",
+    "Ab": "G#",
+}
+
+
 def normalize_chord_spelling(chord, prefer_flats):
     if not chord:
         return chord
 
-    sharp_to_flat = {
-        "A#": "Bb",
-        "C#": "Db",
-        "D#": "Eb",
-        "F#": "Gb",
-        "G#": "Ab",
-    }
-
-    flat_to_sharp = {
-        "Bb": "A#",
-        "Db": "C#",
-        "Eb": "D#",
-        "Gb": "F#",
-        "Ab": "G#",
-    }
-
     # אם הסולם עם במולים
     if prefer_flats:
-        for sharp, flat in sharp_to_flat.items():
+        for sharp, flat in SHARP_TO_FLAT.items():
             if chord.startswith(sharp):
                 return chord.replace(sharp, flat, 1)
     else:
-        for flat, sharp in flat_to_sharp.items():
+        for flat, sharp in FLAT_TO_SHARP.items():
             if chord.startswith(flat):
                 return chord.replace(flat, sharp, 1)
 
     return chord
+
+
+# ---------------------------------------------------
+# CHORD TABLE – כל סימול אקורד מפוענח פעם אחת (שיר = 10–30 סימולים שונים)
+# ---------------------------------------------------
+ParsedChord = namedtuple("ParsedChord", "step alter kind degrees bass_note original")
+
+
+@lru_cache(maxsize=CHORD_CACHE_SIZE)
+def parse_chord_symbol(chord, prefer_flats):
+    # מחזיר (הסימול אחרי נרמול כתיב, ParsedChord או None)
+    spelled = normalize_chord_spelling(chord, prefer_flats)
+
+    parsed = parse_chord_for_xml(spelled)
+    if parsed is None:
+        return spelled, None
+
+    step, alter, kind, degrees, bass_note, original = parsed
+    return spelled, ParsedChord(step, alter, kind, tuple(degrees), bass_note, original)
+
+
+def build_chord_table(symbols, prefer_flats):
+    # symbol -> (spelled, ParsedChord) לכל סימול שונה, לפי סדר הופעה
+    table = {}
+    for symbol in symbols:
+        if symbol not in table:
+            table[symbol] = parse_chord_symbol(symbol, prefer_flats)
+    return table
+
+
+def chord_table_json(table):
+    out = {}
+    for symbol, (spelled, parsed) in table.items():
+        if parsed is None:
+            out[symbol] = None
+            continue
+
+        out[symbol] = {
+            "spelled": spelled,
+            "root_step": parsed.step,
+            "root_alter": parsed.alter,
+            "kind": parsed.kind,
+            "degrees": [
+                {"value": value, "type": dtype, "alter": alter_val}
+                for value, dtype, alter_val in parsed.degrees
+            ],
+            "bass": parsed.bass_note
+        }
+    return out
+
+
+def chord_cache_stats():
+    info = parse_chord_symbol.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "entries": info.currsize,
+        "max_entries": info.maxsize,
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_ratio": info.hits / lookups if lookups else None
+    }
+
+
 # ---------------------------------------------------
 # MUSICXML – בלי הזזות, bar/beat בדיוק כמו ב-JSON
 # ---------------------------------------------------
+# פלט זהה byte-for-byte ל-tostring(score, encoding="utf-8", xml_declaration=True)
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+
+
 def chords_to_musicxml(segments, sections=None, bpm=None, beats=None, key_str=None):
+    return b"".join(iter_musicxml(segments, sections, bpm, beats, key_str))
 
-    score = Element("score-partwise", version="3.1")
 
-    part_list = SubElement(score, "part-list")
-    score_part = SubElement(part_list, "score-part", id="P1")
-    SubElement(score_part, "part-name").text = "Chords"
+def iter_musicxml(segments, sections=None, bpm=None, beats=None, key_str=None):
+    # generator: header + part-list, ואז תיבה אחת בכל פעם – אין DOM מלא בזיכרון
+    key_fifths, key_mode = parse_key_to_musicxml(key_str)
+
+    chord_table = build_chord_table((s.chord for s in segments or ()), key_fifths < 0)
+
+    bars = compile_bars(segments, sections, as_beat_grid(beats), chord_table)
+
+    return render_musicxml(bars, bpm, key_fifths, key_mode)
+
 
-    part = SubElement(score, "part", id="P1")
+# ---------------------------------------------------
+# BARS – תיבה אחרי תיבה: משקל, אקורדים (עם משך בפעמות) ו-sections
+# ---------------------------------------------------
+ChartBar = namedtuple("ChartBar", "index beats beat_type events sections")
+ChordEvent = namedtuple("ChordEvent", "bar beat duration symbol spelled harmony")
+
+
+def beat_type_for(beats_in_bar):
+    return 8 if beats_in_bar in (6, 9, 12) else 4
 
+
+def compile_bars(segments, sections, grid, chord_table, bar_offset=0):
+    # bar של segment = start_bar + bar_offset (0-based); generator – MusicXML נכתב תוך כדי, ה-IR שומר רשימה
     if not segments:
-        return tostring(score, encoding="utf-8", xml_declaration=True)
+        return
 
-    bar_time_map = detect_time_signature_per_bar(beats)
+    bar_time_map = grid.bar_counts
 
     beats_bars = len(bar_time_map) if bar_time_map else 0
-    segments_bars = max(s["end_bar"] for s in segments) + 1 if segments else 0
+    segments_bars = max(s.end_bar for s in segments) + bar_offset + 1
 
     total_bars = max(beats_bars, segments_bars)
 
-    bars = list(range(total_bars))
+    # אינדקסים לפי תיבה – נבנים פעם אחת במקום לסרוק את כל הרשימות בכל תיבה
+    segments_by_bar = {}
+    for s in segments:
+        segments_by_bar.setdefault(s.start_bar + bar_offset, []).append(s)
 
-    key_fifths, key_mode = parse_key_to_musicxml(key_str)
+    sections_by_bar = {}
+    for sec in sections or ():
+        sections_by_bar.setdefault(sec.start_bar, []).append(sec)
+
+    for bar in range(total_bars):
+        beats_in_this_bar = bar_time_map.get(bar, 4)
+
+        # כל האקורדים שמתחילים בתיבה הזו – לפי start_bar מה-JSON
+        starting_here = sorted(segments_by_bar.get(bar, ()), key=attrgetter("start_beat"))
+
+        events = []
+        for idx, seg in enumerate(starting_here):
+            seg_start_beat = seg.start_beat
+
+            # משך – עד האקורד הבא באותה תיבה, או עד סוף התיבה
+            if idx < len(starting_here) - 1:
+                next_beat = starting_here[idx + 1].start_beat
+                dur_beats = max(0, next_beat - seg_start_beat)
+            else:
+                dur_beats = max(0, beats_in_this_bar - seg_start_beat + 1)
+
+            spelled, parsed = chord_table[seg.chord]
+            events.append(ChordEvent(bar, seg_start_beat, dur_beats, seg.chord, spelled, parsed))
+
+        yield ChartBar(
+            bar,
+            beats_in_this_bar,
+            beat_type_for(beats_in_this_bar),
+            tuple(events),
+            tuple(sec.label for sec in sections_by_bar.get(bar, ()))
+        )
+
+
+def render_musicxml(bars, bpm=None, key_fifths=0, key_mode="major"):
+    part_list = Element("part-list")
+    score_part = SubElement(part_list, "score-part", id="P1")
+    SubElement(score_part, "part-name").text = "Chords"
+
+    yield XML_DECLARATION + b'<score-partwise version="3.1">' + tostring(part_list, encoding="utf-8")
+
+    bars = iter(bars)
+    first = next(bars, None)
+
+    if first is None:
+        yield b'<part id="P1" /></score-partwise>'
+        return
 
     divisions = 480
 
-    bar_time_map = detect_time_signature_per_bar(beats)
     previous_beats = None
 
-    for i, bar in enumerate(bars):
-
-        # מספר תיבה = index + 1, בלי offset
-        measure = SubElement(part, "measure", number=str(bar + 1))
+    yield b'<part id="P1">'
 
-        beats_in_this_bar = bar_time_map.get(i, 4)
+    for i, bar in enumerate(chain((first,), bars)):
 
-        if beats_in_this_bar in (6, 9, 12):
-            beat_type_local = 8
-        else:
-            beat_type_local = 4
+        # מספר תיבה = index + 1, בלי offset
+        measure = Element("measure", number=str(bar.index + 1))
 
-        units_per_beat = int(divisions * 4 / beat_type_local)
+        units_per_beat = int(divisions * 4 / bar.beat_type)
 
-        if beats_in_this_bar != previous_beats:
+        if bar.beats != previous_beats:
 
             attributes = SubElement(measure, "attributes")
 
@@ -440,10 +1292,10 @@ def chords_to_musicxml(segments, sections=None, bpm=None, beats=None, key_str=No
                 SubElement(key, "mode").text = key_mode
 
             time_el = SubElement(attributes, "time")
-            SubElement(time_el, "beats").text = str(beats_in_this_bar)
-            SubElement(time_el, "beat-type").text = str(beat_type_local)
+            SubElement(time_el, "beats").text = str(bar.beats)
+            SubElement(time_el, "beat-type").text = str(bar.beat_type)
 
-        previous_beats = beats_in_this_bar
+        previous_beats = bar.beats
 
         # BPM רק בתיבה הראשונה
         if i == 0 and bpm is not None:
@@ -456,17 +1308,11 @@ def chords_to_musicxml(segments, sections=None, bpm=None, beats=None, key_str=No
             sound.set("tempo", str(bpm))
 
         # Sections
-        if sections:
-            for sec in sections:
-                if sec.get("start_bar") == bar:
-                    direction = SubElement(measure, "direction", placement="above")
-                    direction_type = SubElement(direction, "direction-type")
-                    rehearsal = SubElement(direction_type, "rehearsal")
-                    rehearsal.text = sec.get("label") or "Section"
-
-        # כל האקורדים שמתחילים בתיבה הזו – לפי start_bar מה-JSON
-        starting_here = [s for s in segments if s["start_bar"] == bar]
-        starting_here.sort(key=lambda s: s.get("start_beat", 1))
+        for label in bar.sections:
+            direction = SubElement(measure, "direction", placement="above")
+            direction_type = SubElement(direction, "direction-type")
+            rehearsal = SubElement(direction_type, "rehearsal")
+            rehearsal.text = label
 
         current_beat = 1
 
@@ -478,23 +1324,17 @@ def chords_to_musicxml(segments, sections=None, bpm=None, beats=None, key_str=No
             SubElement(note, "rest")
             SubElement(note, "duration").text = str(dur)
 
-        for idx, seg in enumerate(starting_here):
-
-            seg_start_beat = seg.get("start_beat", 1)
+        for event in bar.events:
 
-            gap_beats = seg_start_beat - current_beat
+            gap_beats = event.beat - current_beat
             if gap_beats > 0:
                 add_rest(gap_beats)
                 current_beat += gap_beats
 
-            prefer_flats = key_fifths < 0
-            seg["chord"] = normalize_chord_spelling(seg["chord"], prefer_flats)
-
-            parsed = parse_chord_for_xml(seg["chord"])
-            if not parsed:
+            if not event.harmony:
                 continue
 
-            step, alter, kind, degrees, bass_note, original = parsed
+            step, alter, kind, degrees, bass_note, original = event.harmony
 
             harmony = SubElement(measure, "harmony")
 
@@ -525,232 +1365,2512 @@ def chords_to_musicxml(segments, sections=None, bpm=None, beats=None, key_str=No
                 if alter_val is not None:
                     SubElement(degree, "degree-alter").text = alter_val
 
-            # משך – עד האקורד הבא באותה תיבה, או עד סוף התיבה
-            if idx < len(starting_here) - 1:
-                next_beat = starting_here[idx + 1].get("start_beat", beats_in_this_bar + 1)
-                dur_beats = max(0, next_beat - seg_start_beat)
-            else:
-                dur_beats = max(0, beats_in_this_bar - seg_start_beat + 1)
-
-            if dur_beats > 0:
-                add_rest(dur_beats)
-                current_beat = seg_start_beat + dur_beats
+            if event.duration > 0:
+                add_rest(event.duration)
+                current_beat = event.beat + event.duration
             else:
-                current_beat = seg_start_beat
+                current_beat = event.beat
 
-        if current_beat <= beats_in_this_bar:
-            tail_beats = beats_in_this_bar - current_beat + 1
+        if current_beat <= bar.beats:
+            tail_beats = bar.beats - current_beat + 1
             add_rest(tail_beats)
 
-    return tostring(score, encoding="utf-8", xml_declaration=True)
+        yield tostring(measure, encoding="utf-8")
+
+    yield b"</part></score-partwise>"
 
 
 # ---------------------------------------------------
-# CREATE JOB
+# STREAMING UPLOAD – הקובץ עובר ל-music.ai ב-chunks, לא נטען כולו לזיכרון
 # ---------------------------------------------------
-@app.route("/analyze", methods=["POST"])
-def analyze():
+class UploadStream:
+
+    def __init__(self, fileobj, length, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.length = length
+        self.chunk_size = chunk_size
+        self.sent = 0
+
+    # requests משתמש ב-len כדי לשלוח Content-Length במקום chunked encoding
+    def __len__(self):
+        return self.length - self.sent
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        data = self.fileobj.read(min(size, self.length - self.sent))
+        self.sent += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read()
+            if not data:
+                return
+            yield data
 
-    try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file field named 'file' in form-data"}), 400
 
-        file = request.files["file"]
-        manual_bpm = request.form.get("bpm_override")
+def stream_length(stream):
+    pos = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    end = stream.tell()
+    stream.seek(pos)
+    return end - pos
 
-        if not API_KEY:
-            return jsonify({"error": "API_KEY environment variable is not set"}), 500
 
-        upload_res = requests.get(
-            "https://api.music.ai/v1/upload",
-            headers={"Authorization": API_KEY}
-        )
+def upload_audio(upload_url, stream, length, content_type):
+    body = UploadStream(stream, length)
+
+    started = time.monotonic()
+    put_res = upstream_put(
+        upload_url,
+        call="upload",
+        data=body,
+        headers={"Content-Type": content_type}
+    )
+    elapsed = time.monotonic() - started
+
+    stats = {
+        "bytes": body.sent,
+        "seconds": round(elapsed, 3),
+        "bytes_per_sec": int(body.sent / elapsed) if elapsed > 0 else None
+    }
+    log.info("upload %d bytes in %.3fs (%s B/s)", body.sent, elapsed, stats["bytes_per_sec"])
+
+    return put_res, stats
+
+
+# ---------------------------------------------------
+# ETAG / CONDITIONAL GET – תוצאה של job שהסתיים לא משתנה לעולם
+# ---------------------------------------------------
+def render_etag(kind, job_id, options):
+    key = json.dumps([RENDERER_VERSION, kind, job_id, options], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def is_not_modified(etag):
+    # ETag מונפק רק לתוצאה סופית ושלמה, לכן אפשר לענות 304 עוד לפני הפנייה ל-music.ai
+    return request.if_none_match.contains_weak(etag)
+
+
+def mark_immutable(response, etag):
+    # weak – כי אותו ETag משמש גם לגרסה הדחוסה (gzip/deflate)
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def not_modified(etag):
+    return mark_immutable(Response(status=304), etag)
+
+
+@app.after_request
+def default_cache_control(response):
+    # כל מה שלא סומן במפורש כסופי (PROCESSING, שגיאות, analyze) לא נשמר ב-cache
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+# ---------------------------------------------------
+# COMPRESSED MUSICXML (.mxl)
+# ---------------------------------------------------
+MXL_MIMETYPE = "application/vnd.recordare.musicxml"
+
+MXL_CONTAINER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<container>\n'
+    '  <rootfiles>\n'
+    '    <rootfile full-path="score.musicxml" media-type="application/vnd.recordare.musicxml+xml"/>\n'
+    '  </rootfiles>\n'
+    '</container>\n'
+)
+
+
+def build_mxl(xml_chunks):
+    # ה-XML נכתב ל-zip ב-chunks, כך שרק הגרסה הדחוסה נשמרת בזיכרון
+    buf = BytesIO()
+
+    with zipfile.ZipFile(buf, "w") as zf:
+        # לפי התקן: mimetype ראשון ולא דחוס
+        zf.writestr("mimetype", MXL_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", MXL_CONTAINER, compress_type=zipfile.ZIP_DEFLATED)
+
+        info = zipfile.ZipInfo("score.musicxml", date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with zf.open(info, "w") as entry:
+            for chunk in xml_chunks:
+                entry.write(chunk)
+
+    return buf.getvalue()
+
+
+# ---------------------------------------------------
+# RESPONSE COMPRESSION – gzip/deflate לפי Accept-Encoding
+# ---------------------------------------------------
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/xml", "text/plain")
+STREAM_FLUSH_BYTES = 64 * 1024
+
+
+def compressor(encoding):
+    # gzip = wbits 31, deflate של HTTP = פורמט zlib (wbits 15)
+    wbits = 31 if encoding == "gzip" else 15
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+
+
+def compress_stream(chunks, encoding):
+    z = compressor(encoding)
+    pending = 0
+
+    try:
+        for chunk in chunks:
+            out = z.compress(chunk)
+            pending += len(chunk)
+
+            # flush מדי פעם כדי שהלקוח יקבל bytes מוקדם ולא רק בסוף
+            if pending >= STREAM_FLUSH_BYTES:
+                out += z.flush(zlib.Z_SYNC_FLUSH)
+                pending = 0
+
+            if out:
+                yield out
+
+        yield z.flush()
+
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+
+    if "Content-Encoding" in response.headers or response.direct_passthrough:
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    encoding = request.accept_encodings.best_match(("gzip", "deflate"))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+
+        z = compressor(encoding)
+        response.set_data(z.compress(data) + z.flush())
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+# ---------------------------------------------------
+# CREATE JOB
+# ---------------------------------------------------
+class UpstreamError(Exception):
+
+    def __init__(self, error, status_code=None, response=None):
+        super().__init__(error)
+        self.error = error
+        self.status_code = status_code
+        self.response = response
+
+    def to_json(self):
+        body = {"error": self.error}
+        if self.status_code is not None:
+            body["status_code"] = self.status_code
+        if self.response is not None:
+            body["response"] = self.response
+        return body
+
+
+def submit_job(stream, length, content_type, filename, manual_bpm):
+    upload_res = upstream_get(
+        f"{MUSIC_AI_URL}/v1/upload",
+        call="upload_url",
+        headers={"Authorization": API_KEY}
+    )
+
+    if upload_res.status_code != 200:
+        raise UpstreamError(
+            "Failed to get upload URL from music.ai",
+            upload_res.status_code,
+            upload_res.text
+        )
+
+    upload_data = upload_res.json()
+
+    upload_url = upload_data.get("uploadUrl")
+    download_url = upload_data.get("downloadUrl")
+
+    if not upload_url or not download_url:
+        raise UpstreamError("music.ai upload response missing URLs", response=upload_data)
+
+    put_res, upload_stats = upload_audio(upload_url, stream, length, content_type)
+
+    if put_res.status_code not in (200, 201):
+        raise UpstreamError(
+            "Failed to upload file to music.ai storage",
+            put_res.status_code,
+            put_res.text
+        )
+
+    params = {"Input 1": download_url}
+
+    if manual_bpm:
+        params["manual_bpm"] = manual_bpm
+
+    job_res = upstream_post(
+        f"{MUSIC_AI_URL}/api/job",
+        call="job_create",
+        headers={
+            "accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": API_KEY
+        },
+        json={
+            "name": filename,
+            "workflow": WORKFLOW,
+            "params": params
+        }
+    )
+
+    if job_res.status_code != 200:
+        raise UpstreamError(
+            "Failed to create job in music.ai",
+            job_res.status_code,
+            job_res.text
+        )
+
+    job_data = job_res.json()
+
+    return job_data.get("id"), upload_stats
+
+
+def wants_async():
+    return (request.values.get("async") or "").lower() in ("1", "true", "yes")
+
+
+def submit_upload(file, manual_bpm):
+    # העלאה סינכרונית של קובץ אחד – מחזיר את ה-dict לתשובה
+
+    # אותו קובץ (ואותו bpm_override) כבר נשלח – מחזירים את ה-job הקיים
+    dedup_key = upload_dedup_key(hash_stream(file.stream), manual_bpm)
+    existing_job_id = dedup_index.lookup(dedup_key)
+    if existing_job_id:
+        return {"job_id": existing_job_id, "deduplicated": True}
+
+    job_id, upload_stats = submit_job(
+        file.stream,
+        stream_length(file.stream),
+        file.content_type,
+        file.filename,
+        manual_bpm
+    )
+    dedup_index.record(dedup_key, job_id)
+    job_poller.track(job_id)
+
+    return {"job_id": job_id, "upload": upload_stats}
+
+
+@app.route("/analyze", methods=["POST"])
+def analyze():
+
+    try:
+        if "file" not in request.files:
+            return jsonify({"error": "No file field named 'file' in form-data"}), 400
+
+        files = request.files.getlist("file")
+        manual_bpm = request.form.get("bpm_override")
+
+        if not API_KEY:
+            return jsonify({"error": "API_KEY environment variable is not set"}), 500
+
+        if len(files) > 1 or "manifest" in request.form:
+            return analyze_many(files, manual_bpm)
+
+        file = files[0]
+
+        if wants_async():
+            queued = enqueue_submission(file, manual_bpm)
+            if queued is None:
+                return jsonify({"error": "Submission queue is full, try again later"}), 503
+            if "ticket_id" not in queued:
+                return jsonify(queued)
+            return jsonify(queued), 202
+
+        return jsonify(submit_upload(file, manual_bpm))
+
+    except UpstreamError as e:
+        return jsonify(e.to_json()), 502
+
+    except Exception as e:
+        return jsonify({"error": "Unexpected server error", "details": str(e)}), 500
+
+
+# ---------------------------------------------------
+# MULTI-FILE ANALYZE – כמה קבצים בבקשה אחת, העלאות במקביל
+# ---------------------------------------------------
+# pool לכל התהליך – מגביל כמה העלאות ל-music.ai רצות בו-זמנית
+analyze_pool = ThreadPoolExecutor(
+    max_workers=ANALYZE_CONCURRENCY,
+    thread_name_prefix="analyze"
+)
+
+
+def parse_manifest(raw):
+    # manifest = [{"filename": "...", "bpm_override": "..."}] → filename -> bpm_override
+    if not raw:
+        return {}
+
+    entries = json.loads(raw)
+    if not isinstance(entries, list) or not all(isinstance(e, dict) and e.get("filename") for e in entries):
+        raise ValueError("manifest must be a JSON list of objects with a filename")
+
+    return {e["filename"]: e.get("bpm_override") for e in entries}
+
+
+def submit_batch_entry(file, manual_bpm, use_async):
+    # קובץ שנכשל מחזיר שגיאה משלו ולא עוצר את שאר הקבצים
+    entry = {"filename": file.filename}
+
+    try:
+        if use_async:
+            queued = enqueue_submission(file, manual_bpm)
+            if queued is None:
+                entry["error"] = "Submission queue is full, try again later"
+            else:
+                entry.update(queued)
+        else:
+            entry.update(submit_upload(file, manual_bpm))
+
+    except UpstreamError as e:
+        entry.update(e.to_json())
+
+    except Exception as e:
+        log.exception("upload of %s failed", file.filename)
+        entry.update({"error": "Unexpected server error", "details": str(e)})
+
+    return entry
+
+
+def analyze_many(files, manual_bpm):
+    try:
+        manifest = parse_manifest(request.form.get("manifest"))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid manifest: {e}"}), 400
+
+    if len(files) > ANALYZE_MAX_FILES:
+        return jsonify({"error": f"At most {ANALYZE_MAX_FILES} files per request"}), 400
+
+    use_async = wants_async()
+
+    futures = [
+        analyze_pool.submit(submit_batch_entry, file, manifest.get(file.filename) or manual_bpm, use_async)
+        for file in files
+    ]
+    jobs = [future.result() for future in futures]
+
+    if all("error" in job for job in jobs):
+        return jsonify({"jobs": jobs}), 502
+
+    return jsonify({"jobs": jobs})
+
+
+# ---------------------------------------------------
+# LOCAL DATABASE – SQLite ב-DATA_DIR, משותף לכל ה-workers ושורד restart
+# ---------------------------------------------------
+# pool קטן לכל קובץ, לכל התהליך – לא threading.local: ב-worker של gevent הוא לכל greenlet,
+# וכל בקשה הייתה פותחת connection חדש. ב-gevent אין החלפת greenlet בזמן פעולת SQLite,
+# כך שבפועל יש connection אחד לכל קובץ; עם threads – עד DB_POOL_SIZE
+DB_POOL_SIZE = 4
+
+
+def reset_db_pools():
+    # אחרי fork – connections של ההורה לא שלנו
+    global db_pools, db_pools_lock
+    db_pools = {}
+    db_pools_lock = threading.Lock()
+
+
+reset_db_pools()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_db_pools)
+
+
+@contextmanager
+def open_db(name, directory=DATA_DIR):
+    # connection מושאל לפעולה אחת ומוחזר ל-pool; WAL מאפשר קוראים במקביל לכותב
+    path = os.path.join(directory, name)
+
+    with db_pools_lock:
+        pool = db_pools.setdefault(path, [])
+        conn = pool.pop() if pool else None
+
+    if conn is None:
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+    try:
+        yield conn
+    finally:
+        # transaction שנשארה פתוחה (exception באמצע) לא עוברת לשואל הבא
+        if conn.in_transaction:
+            conn.rollback()
+
+        with db_pools_lock:
+            if len(pool) < DB_POOL_SIZE:
+                pool.append(conn)
+                conn = None
+
+        if conn is not None:
+            conn.close()
+
+
+# ---------------------------------------------------
+# UPLOAD DEDUP – hash של האודיו + bpm_override → job_id קיים
+# ---------------------------------------------------
+def hash_stream(stream):
+    pos = stream.tell()
+    digest = hashlib.sha256()
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    stream.seek(pos)
+    return digest.hexdigest()
+
+
+def upload_dedup_key(content_hash, manual_bpm):
+    return f"{content_hash}|{WORKFLOW}|{manual_bpm or ''}"
+
+
+class DedupIndex:
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._ready = False
+
+    @contextmanager
+    def _db(self):
+        with open_db(self.db_name) as conn:
+            if not self._ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS dedup ("
+                    "key TEXT PRIMARY KEY, job_id TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS dedup_job ON dedup (job_id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS dedup_last_used ON dedup (last_used)")
+                self._ready = True
+            yield conn
+
+    # תקלה ב-index לא מפילה את ההעלאה – פשוט ממשיכים בלי dedup
+    def lookup(self, key):
+        try:
+            with self._db() as conn:
+                row = conn.execute(
+                    "SELECT job_id FROM dedup WHERE key = ? AND created > ?",
+                    (key, time.time() - DEDUP_TTL)
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE dedup SET last_used = ? WHERE key = ?", (time.time(), key))
+                return row[0]
+        except sqlite3.Error as e:
+            log.warning("dedup lookup failed: %s", e)
+            return None
+
+    def record(self, key, job_id):
+        if not job_id:
+            return
+        try:
+            with self._db() as conn:
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO dedup (key, job_id, created, last_used) VALUES (?, ?, ?, ?)",
+                    (key, job_id, now, now)
+                )
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            log.warning("dedup record failed: %s", e)
+
+    def forget_job(self, job_id):
+        try:
+            with self._db() as conn:
+                conn.execute("DELETE FROM dedup WHERE job_id = ?", (job_id,))
+        except sqlite3.Error as e:
+            log.warning("dedup forget failed: %s", e)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM dedup WHERE created <= ?", (now - DEDUP_TTL,))
+        conn.execute(
+            "DELETE FROM dedup WHERE key IN ("
+            "SELECT key FROM dedup ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (DEDUP_MAX_ENTRIES,)
+        )
+
+
+dedup_index = DedupIndex("dedup.sqlite3")
+
+
+# ---------------------------------------------------
+# ASYNC SUBMISSION – הקובץ נשמר מקומית, העלאה ויצירת job ברקע
+# ---------------------------------------------------
+# מצב ה-ticket נשמר כקובץ JSON ב-SPOOL_DIR כדי שכל worker של gunicorn יראה אותו
+TICKET_RE = re.compile(r"^t_[0-9a-f]{32}$")
+
+submission_pool = ThreadPoolExecutor(
+    max_workers=SUBMIT_WORKERS,
+    thread_name_prefix="submit"
+)
+submission_slots = threading.BoundedSemaphore(SUBMIT_QUEUE_SIZE)
+last_ticket_prune = [0.0]
+
+
+def is_ticket(job_id):
+    return bool(TICKET_RE.match(job_id or ""))
+
+
+def ticket_path(ticket_id, ext):
+    return os.path.join(SPOOL_DIR, f"{ticket_id}.{ext}")
+
+
+def write_ticket(ticket_id, state):
+    tmp = ticket_path(ticket_id, f"json.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, ticket_path(ticket_id, "json"))
+
+
+def read_ticket(ticket_id):
+    try:
+        with open(ticket_path(ticket_id, "json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prune_tickets():
+    now = time.time()
+    if now - last_ticket_prune[0] < 60:
+        return
+    last_ticket_prune[0] = now
+
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > TICKET_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def spool_upload(file, path):
+    # שומר לדיסק ומחשב hash תוך כדי – בלי מעבר נוסף על הקובץ
+    digest = hashlib.sha256()
+    with open(path, "wb") as out:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+def enqueue_submission(file, manual_bpm):
+    # None = התור מלא; אחרת dict לתשובה (ticket חדש או job קיים מה-dedup)
+    if not submission_slots.acquire(blocking=False):
+        return None
+
+    try:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        prune_tickets()
+
+        ticket_id = f"t_{uuid.uuid4().hex}"
+        audio_path = ticket_path(ticket_id, "audio")
+        dedup_key = upload_dedup_key(spool_upload(file, audio_path), manual_bpm)
+
+        existing_job_id = dedup_index.lookup(dedup_key)
+        if existing_job_id:
+            os.remove(audio_path)
+            submission_slots.release()
+            return {"job_id": existing_job_id, "deduplicated": True}
+
+        write_ticket(ticket_id, {"status": "QUEUED", "created": time.time()})
+
+        submission_pool.submit(
+            run_submission,
+            ticket_id,
+            audio_path,
+            file.content_type,
+            file.filename,
+            manual_bpm,
+            dedup_key
+        )
+        return {"ticket_id": ticket_id, "job_id": ticket_id, "status": "QUEUED"}
+
+    except Exception:
+        submission_slots.release()
+        raise
+
+
+def run_submission(ticket_id, audio_path, content_type, filename, manual_bpm, dedup_key=None):
+    try:
+        write_ticket(ticket_id, {"status": "UPLOADING", "created": time.time()})
+
+        with open(audio_path, "rb") as stream:
+            job_id, upload_stats = submit_job(
+                stream,
+                stream_length(stream),
+                content_type,
+                filename,
+                manual_bpm
+            )
+
+        write_ticket(ticket_id, {"status": "SUBMITTED", "job_id": job_id, "upload": upload_stats})
+        if dedup_key:
+            dedup_index.record(dedup_key, job_id)
+        job_poller.track(job_id)
+
+    except UpstreamError as e:
+        write_ticket(ticket_id, dict(e.to_json(), status="FAILED"))
+
+    except Exception as e:
+        log.exception("submission %s failed", ticket_id)
+        write_ticket(ticket_id, {"status": "FAILED", "error": "Unexpected server error", "details": str(e)})
+
+    finally:
+        submission_slots.release()
+        try:
+            os.remove(audio_path)
+        except OSError:
+            pass
+
+
+def resolve_ticket(job_id):
+    # מחזיר (job_id של music.ai או None, מצב ה-ticket או None)
+    if not is_ticket(job_id):
+        return job_id, None
+
+    ticket = read_ticket(job_id)
+    if ticket is None:
+        return None, {"status": "UNKNOWN", "error": "Unknown ticket"}
+
+    return ticket.get("job_id"), ticket
+
+
+# ---------------------------------------------------
+# RESULT CACHE – רק תוצאות SUCCEEDED, הן לא משתנות
+# ---------------------------------------------------
+class ResultCache:
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            expires_at, size, value = item
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                self.misses += 1
+                return None
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+
+            self._items[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._items))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, size, _ = self._items.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else None
+            }
+
+
+def estimate_size(value):
+    return len(json.dumps(value, separators=(",", ":"), default=json_default))
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+
+# ---------------------------------------------------
+# ARTIFACTS – chords / beats / sections במקביל
+# ---------------------------------------------------
+# pool אחד לכל התהליך, כדי שפרץ של בקשות status לא יפתח אינסוף sockets
+artifact_pool = ThreadPoolExecutor(
+    max_workers=ARTIFACT_FETCH_CONCURRENCY,
+    thread_name_prefix="artifact"
+)
+
+
+def fetch_artifact(name, url):
+    res = upstream_get(url, call=f"artifact_{name}", timeout=(UPSTREAM_CONNECT_TIMEOUT, ARTIFACT_TIMEOUT))
+    res.raise_for_status()
+    return res.json()
+
+
+def fetch_artifacts(urls, required=()):
+    # urls: name -> url. חובה: נכשל → exception. אופציונלי: נכשל → None
+    futures = {
+        name: artifact_pool.submit(fetch_artifact, name, url)
+        for name, url in urls.items()
+        if url
+    }
+    wait(futures.values(), timeout=ARTIFACT_TIMEOUT)
+
+    artifacts = {name: None for name in urls}
+    complete = True
+
+    for name, future in futures.items():
+        try:
+            if not future.done():
+                future.cancel()
+                raise requests.Timeout(f"Timed out downloading {name} artifact")
+            artifacts[name] = future.result()
+        except Exception as e:
+            if name in required:
+                if isinstance(e, requests.RequestException):
+                    raise
+                raise requests.RequestException(f"Failed to download {name} artifact: {e}")
+            log.warning("optional artifact %s failed: %s", name, e)
+            complete = False
+
+    for name in required:
+        if name not in futures:
+            raise requests.RequestException(f"music.ai result has no {name} artifact")
+
+    return artifacts, complete
+
+
+# ---------------------------------------------------
+# SINGLE-FLIGHT – קריאות מקבילות לאותו job חולקות בקשה אחת ל-music.ai
+# ---------------------------------------------------
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+
+analysis_flight = SingleFlight()
+
+
+# ---------------------------------------------------
+# JOB POLLER – thread אחד שעוקב אחרי jobs פתוחים עם backoff
+# ---------------------------------------------------
+class JobPoller:
+
+    def __init__(self):
+        self._jobs = {}
+        # job_id -> (state, נראה ב-, version). version עולה רק כשהמצב משתנה
+        self._states = {}
+        self._seq = 0
+        # lock אחד: Condition של thread ה-poller ו-Condition לכל job שיש לו צופים
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        # job_id -> [Condition, מספר צופים]
+        self._watchers = {}
+        self._thread = None
+
+    def track(self, job_id):
+        if not job_id:
+            return
+
+        with self._cond:
+            if job_id not in self._jobs:
+                if len(self._jobs) >= POLL_MAX_JOBS:
+                    return
+                now = time.monotonic()
+                self._jobs[job_id] = {
+                    "due": now + POLL_MIN_INTERVAL,
+                    "interval": POLL_MIN_INTERVAL,
+                    "since": now
+                }
+
+            # thread נפתח רק בתוך ה-worker (אחרי fork של gunicorn)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="job-poller", daemon=True)
+                self._thread.start()
+
+            self._cond.notify()
+
+    def observe(self, job_id, state):
+        if state not in TERMINAL_STATES:
+            self.track(job_id)
+
+        with self._cond:
+            previous = self._states.get(job_id)
+            changed = previous is None or previous[0] != state
+
+            if changed:
+                self._seq += 1
+
+            if state in TERMINAL_STATES:
+                self._jobs.pop(job_id, None)
+                self._states.pop(job_id, None)
+            elif job_id in self._jobs:
+                self._states[job_id] = (state, time.monotonic(), self._seq if changed else previous[2])
+
+            # מעירים רק את הצופים (long-poll / SSE) של ה-job הזה, ורק כשהמצב באמת השתנה
+            if changed:
+                self._notify_watchers(job_id)
+
+    def version(self, job_id):
+        # 0 = אין מצב רשום (לא במעקב, או שהגיע למצב סופי)
+        with self._cond:
+            seen = self._states.get(job_id)
+        return seen[2] if seen else 0
+
+    def wait_for_change(self, job_id, version, timeout):
+        # מחכה עד ש-version של job_id שונה מ-version; False אם עבר timeout בלי שינוי
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            watcher = self._watchers.get(job_id)
+            if watcher is None:
+                watcher = self._watchers[job_id] = [threading.Condition(self._lock), 0]
+            watcher[1] += 1
+
+            try:
+                while self.version(job_id) == version:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    watcher[0].wait(remaining)
+                return True
+            finally:
+                watcher[1] -= 1
+                if not watcher[1]:
+                    del self._watchers[job_id]
+
+    def is_tracked(self, job_id):
+        with self._cond:
+            return job_id in self._jobs
+
+    def _notify_watchers(self, job_id):
+        watcher = self._watchers.get(job_id)
+        if watcher is not None:
+            watcher[0].notify_all()
+
+    def recent_state(self, job_id):
+        with self._cond:
+            seen = self._states.get(job_id)
+
+        if seen and time.monotonic() - seen[1] < STATUS_FRESH_SECONDS:
+            return seen[0]
+        return None
+
+    def tracked(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [job_id for job_id, job in self._jobs.items() if job["due"] <= now]
+
+                if not due:
+                    next_due = min((job["due"] for job in self._jobs.values()), default=None)
+                    self._cond.wait(None if next_due is None else next_due - now)
+                    continue
+
+            for job_id in due:
+                self._poll(job_id)
+
+    def _poll(self, job_id):
+        try:
+            # SUCCEEDED → fetch_analysis כבר מוריד את ה-artifacts ושומר ב-cache
+            fetch_analysis(job_id)
+        except Exception as e:
+            log.warning("poll of job %s failed: %s", job_id, e)
+
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+
+            now = time.monotonic()
+            if now - job["since"] > POLL_MAX_AGE:
+                del self._jobs[job_id]
+                self._states.pop(job_id, None)
+                # הצופים חוזרים לבדוק בעצמם – אף אחד כבר לא יעיר אותם
+                self._notify_watchers(job_id)
+                return
+
+            job["interval"] = min(job["interval"] * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            job["due"] = now + job["interval"]
+
+
+job_poller = JobPoller()
+
+
+# ---------------------------------------------------
+# ANALYSIS STORE – תוצאות מעובדות ב-SQLite, משותפות לכל ה-workers
+# ---------------------------------------------------
+class AnalysisStore:
+
+    def __init__(self, db_name, max_bytes):
+        self.db_name = db_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._ready = False
+
+    @contextmanager
+    def _db(self):
+        with open_db(self.db_name) as conn:
+            if not self._ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS analyses ("
+                    "job_id TEXT PRIMARY KEY, schema INTEGER NOT NULL, data BLOB NOT NULL, "
+                    "size INTEGER NOT NULL, stored REAL NOT NULL, last_access REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS analyses_last_access ON analyses (last_access)")
+                self._ready = True
+            yield conn
+
+    # מחזיר (result, derived) או None. derived = None אם נשמר בגרסת schema אחרת
+    def get(self, job_id):
+        try:
+            with self._db() as conn:
+                row = conn.execute(
+                    "SELECT schema, data, last_access FROM analyses WHERE job_id = ?",
+                    (job_id,)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                schema, data, last_access = row
+
+                now = time.time()
+                if now - last_access > 60:
+                    conn.execute("UPDATE analyses SET last_access = ? WHERE job_id = ?", (now, job_id))
+
+            record = json.loads(zlib.decompress(data))
+
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            log.warning("analysis store read of %s failed: %s", job_id, e)
+            return None
+
+        self.hits += 1
+        result = tuple(record["analysis"]) + ("SUCCEEDED",)
+        derived = record.get("derived") if schema == STORE_SCHEMA_VERSION else None
+        if derived is not None:
+            derived = {
+                "segments": [ChordSegment.from_json(s) for s in derived["segments"]],
+                "timeline": [TimelineChord.from_json(c) for c in derived["timeline"]]
+            }
+        return result, derived
+
+    def put(self, job_id, result, derived):
+        record = {"analysis": list(result[:-1]), "derived": derived}
+        data = zlib.compress(json.dumps(record, separators=(",", ":"), default=json_default).encode("utf-8"), 6)
+
+        try:
+            with self._db() as conn:
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO analyses (job_id, schema, data, size, stored, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, STORE_SCHEMA_VERSION, data, len(data), now, now)
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            log.warning("analysis store write of %s failed: %s", job_id, e)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # מוחקים את הפחות-בשימוש עד שחוזרים מתחת לגבול
+        excess = total - self.max_bytes
+        victims = []
+        for job_id, size in conn.execute("SELECT job_id, size FROM analyses ORDER BY last_access"):
+            victims.append((job_id,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM analyses WHERE job_id = ?", victims)
+
+    def stats(self):
+        try:
+            with self._db() as conn:
+                count, total = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses"
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        return {"entries": count, "bytes": total, "max_bytes": self.max_bytes}
+
+
+analysis_store = AnalysisStore("analyses.sqlite3", STORE_MAX_BYTES)
+
+
+# ---------------------------------------------------
+# FETCH ANALYSIS
+# ---------------------------------------------------
+def pending_result(state):
+    return None, None, None, None, None, None, None, None, None, None, state
+
+
+@metrics.timed("fetch_analysis")
+def fetch_analysis(job_id):
+    # מחזיר (result, complete); complete=False – beats/sections נכשלו, התוצאה לא סופית
+    # התוצאה משותפת (cache / single-flight) – אסור לשנות אותה במקום
+    cached = result_cache.get(job_id)
+    if cached is not None:
+        # job שעדיין במעקב (request אחר שמר אותו) – ה-poller מפסיק ומעיר את הצופים
+        if job_poller.is_tracked(job_id):
+            job_poller.observe(job_id, cached[-1])
+        return cached, True
+
+    return analysis_flight.do(job_id, fetch_analysis_shared, job_id)
+
+
+def fetch_analysis_shared(job_id):
+    # job שכבר עובד (ע"י worker כלשהו, גם לפני restart) נטען מה-store המקומי
+    stored = analysis_store.get(job_id)
+    if stored is not None:
+        result, derived = stored
+        if derived is None:
+            derived = derive_chart(result[0])
+            analysis_store.put(job_id, result, derived)
+        remember_analysis(job_id, result, derived)
+        job_poller.observe(job_id, "SUCCEEDED")
+        return result, True
+
+    # מצב שה-poller (או לקוח אחר) ראה לפני רגע – לא פונים שוב ל-music.ai.
+    # נבדק אחרי ה-store: worker אחר אולי כבר שמר את התוצאה
+    state = job_poller.recent_state(job_id)
+    if state is not None:
+        return pending_result(state), True
+
+    result, complete = fetch_analysis_upstream(job_id)
+    state = result[-1]
+
+    # תוצאה חלקית (beats/sections נכשלו) לא נשמרת – ננסה שוב בבקשה הבאה
+    if state == "SUCCEEDED" and complete:
+        derived = derive_chart(result[0])
+        remember_analysis(job_id, result, derived)
+        analysis_store.put(job_id, result, derived)
+
+    # job שנכשל לא יוחזר שוב כתוצאה של dedup – העלאה חוזרת תיצור job חדש
+    if state == "FAILED":
+        dedup_index.forget_job(job_id)
+
+    job_poller.observe(job_id, state)
+
+    return result, complete
+
+
+def derive_chart(chords):
+    return {
+        "segments": build_segments(chords),
+        "timeline": build_timeline_segments(chords)
+    }
+
+
+def remember_analysis(job_id, result, derived):
+    result_cache.put(job_id, result, estimate_size(result))
+    result_cache.put((job_id, "derived"), derived, estimate_size(derived))
+
+
+def chart_derived(job_id, chords):
+    # segments / timeline של ה-chords המקוריים (בלי bpm scaling) – משותפים, לקריאה בלבד
+    derived = result_cache.get((job_id, "derived"))
+    if derived is None:
+        derived = derive_chart(chords)
+        result_cache.put((job_id, "derived"), derived, estimate_size(derived))
+    return derived
+
+
+def fetch_analysis_upstream(job_id):
+
+    status_res = upstream_get(
+        f"{MUSIC_AI_URL}/api/job/{job_id}",
+        call="job_status",
+        headers={"Authorization": API_KEY}
+    )
+
+    status_data = status_res.json()
+
+    if status_data["status"] != "SUCCEEDED":
+        return pending_result(status_data["status"]), True
+
+    result = status_data["result"]
+
+    chords_url = result.get("chords") or result.get("Chords")
+    beats_url = result.get("Beats") or result.get("beats")
+    sections_url = result.get("Sections") or result.get("sections")
+
+    detected_bpm = result.get("Bpm") or result.get("bpm")
+    manual_bpm = result.get("manual_bpm") or None
+    root_key = result.get("root key") or result.get("root_key")
+    title = result.get("Title") or result.get("title")
+    artist = result.get("Artist") or result.get("artist")
+    isrc = result.get("ISRC") or result.get("isrc")
+    language = result.get("Language") or result.get("language")
+
+    # chords חובה; beats ו-sections אופציונליים – כישלון שלהם לא מפיל את הבקשה
+    artifacts, complete = fetch_artifacts(
+        {"chords": chords_url, "beats": beats_url, "sections": sections_url},
+        required=("chords",)
+    )
+
+    chords_json = artifacts["chords"]
+
+    if isinstance(chords_json, dict):
+        chords = chords_json.get("chords", chords_json)
+    else:
+        chords = chords_json
+
+    beats = artifacts["beats"]
+    sections = artifacts["sections"]
+
+    return (chords, sections, beats, detected_bpm, manual_bpm, root_key, title, artist, isrc, language, "SUCCEEDED"), complete
+
+
+# ---------------------------------------------------
+# COLUMNAR LAYOUT – ?layout=columnar, מערכים מקבילים במקום dict לכל beat/אקורד
+# ---------------------------------------------------
+# זמנים נשלחים כ-fixed-point שלמים (יחידות של 1/TIME_SCALE שנייה) ב-delta encoding:
+# time[i] = sum(time_deltas[:i + 1]) / time_scale
+TIME_SCALE = 10000
+
+
+def delta_encode(values):
+    if any(v != v for v in values):
+        # יש beat בלי זמן (NaN) – null, וה-delta הבא יחסי לזמן התקין הקודם
+        out = []
+        previous = 0
+        for v in values:
+            if v != v:
+                out.append(None)
+                continue
+            q = round(v * TIME_SCALE)
+            out.append(q - previous)
+            previous = q
+        return out
+
+    quantized = list(map(round, map(mul, values, repeat(TIME_SCALE))))
+    return list(map(sub, quantized, [0] + quantized[:-1]))
+
+
+def beat_columns(grid, start=0, stop=None):
+    # start/stop – טווח beats (עמוד של תיבות); בלי – כל השיר
+    times = grid.times if start == 0 and stop is None else grid.times[start:stop]
+    return {
+        "time_scale": TIME_SCALE,
+        "time_deltas": delta_encode(times),
+        "beat_num": grid.beat_nums[start:stop].tolist()
+    }
+
+
+def timeline_columns(timeline):
+    # כמו build_timeline_segments, אבל אקורד = אינדקס לטבלת סימולים
+    symbols = []
+    symbol_index = {}
+    chord_ids = []
+    starts = array("d")
+    ends = array("d")
+
+    for c in timeline:
+        chord = c.chord
+
+        index = symbol_index.get(chord)
+        if index is None:
+            index = symbol_index[chord] = len(symbols)
+            symbols.append(chord)
+
+        chord_ids.append(index)
+        starts.append(c.start)
+        ends.append(c.end)
+
+    start_q = list(map(round, map(mul, starts, repeat(TIME_SCALE))))
+    end_q = list(map(round, map(mul, ends, repeat(TIME_SCALE))))
+
+    return {
+        "time_scale": TIME_SCALE,
+        "symbols": symbols,
+        "chord": chord_ids,
+        "start_deltas": list(map(sub, start_q, [0] + start_q[:-1])),
+        "durations": list(map(sub, end_q, start_q))
+    }
+
+
+# ---------------------------------------------------
+# INTERVAL INDEX – "אילו רשומות חופפות לטווח" ב-O(log n + k)
+# ---------------------------------------------------
+class IntervalIndex:
+
+    def __init__(self, entries, start_key, end_key):
+        # ממוין לפי start; max_end[i] = הסוף המאוחר ביותר מבין 0..i (לא יורד)
+        start_of = attrgetter(start_key)
+        self.end_of = end_of = attrgetter(end_key)
+
+        self.entries = sorted(entries, key=start_of)
+        self.starts = array("d", map(start_of, self.entries))
+        self.max_end = array("d")
+
+        latest = float("-inf")
+        for e in self.entries:
+            latest = max(latest, end_of(e))
+            self.max_end.append(latest)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def size(self):
+        return estimate_size(self.entries) + self.starts.itemsize * len(self.starts) * 2
+
+    def overlapping(self, t0, t1):
+        # חופף אם start < t1 ו-end > t0; ב-t0 == t1 – הרשומה שמכילה את הנקודה
+        hi = bisect_right(self.starts, t1) if t0 == t1 else bisect_left(self.starts, t1)
+
+        # לפני lo כל הרשומות נגמרו עד t0 – לא צריך לבדוק אותן
+        lo = bisect_right(self.max_end, t0)
+
+        return [self.entries[i] for i in range(lo, hi) if self.end_of(self.entries[i]) > t0]
+
+    def between(self, first, last):
+        # טווח סגור: start <= last ו-end >= first (למשל bars, שבהם end_bar כולל)
+        hi = bisect_right(self.starts, last)
+        lo = bisect_left(self.max_end, first)
+
+        return [self.entries[i] for i in range(lo, hi) if self.end_of(self.entries[i]) >= first]
+
+
+# ---------------------------------------------------
+# TIMELINE INDEX – אקורדים לפי זמן, עם bar/beat מה-grid
+# ---------------------------------------------------
+class TimelineIndex(IntervalIndex):
+
+    def __init__(self, timeline, grid):
+        super().__init__(timeline, "start", "end")
+        self.grid = grid
+
+    def position(self, t):
+        # bar 1-based כמו ב-chart של music.ai (0 = אנקרוזה); בלי beats – None
+        if not len(self.grid):
+            return None
+        bar, beat = self.grid.locate(t)
+        return {"bar": bar + 1, "beat": beat}
+
+    def query(self, t0, t1):
+        return [
+            dict(c.to_json(), start_pos=self.position(c.start), end_pos=self.position(c.end))
+            for c in self.overlapping(t0, t1)
+        ]
+
+
+# ---------------------------------------------------
+# CHART IR – ניתוח מעובד פעם אחת לכל (job, bpm_override); כל פורמט הוא רק renderer
+# ---------------------------------------------------
+class ChartIR:
+
+    @metrics.timed("compile_chart")
+    def __init__(self, job_id, analysis, bpm_override=None, complete=True):
+        chords, sections, beats, detected_bpm, manual_bpm, root_key, title, artist, isrc, language, _ = analysis
+
+        # complete=False – נבנה מתוצאה חלקית (beats/sections נכשלו): בלי ETag / immutable
+        self.complete = complete
+
+        if bpm_override is not None:
+            manual_bpm = bpm_override
+
+        self.scale = None
+        if manual_bpm:
+            self.scale = bpm_scale(detected_bpm, manual_bpm)
+            self.bpm = float(manual_bpm)
+        else:
+            self.bpm = float(detected_bpm) if detected_bpm else None
+
+        # ה-grid נבנה מה-beats המקוריים ומוקטן כעמודה – בלי dict לכל beat / אקורד
+        grid = BeatGrid(beats)
+        derived = chart_derived(job_id, chords)
+
+        if self.scale is None:
+            self.segments = derived["segments"]
+            self.timeline = derived["timeline"]
+        else:
+            grid = grid.rescaled(self.scale)
+            self.segments = scale_segments(derived["segments"], self.scale)
+            self.timeline = scale_timeline(derived["timeline"], self.scale)
+
+        self.grid = grid
+        self.meter = grid.meter
+        self.sections = sections
+        self._beats = beats
+
+        self.key = root_key
+        self.key_fifths, self.key_mode = parse_key_to_musicxml(root_key)
+        self.chord_table = build_chord_table((s.chord for s in self.segments), self.key_fifths < 0)
+
+        self.metadata = {"title": title, "artist": artist, "isrc": isrc, "language": language}
+
+        # bars 0-based (ב-JSON של music.ai הם 1-based) – המקור של MusicXML, ChordPro ו-MIDI
+        section_marks = map_sections_to_bars(sections, grid) if sections else None
+        self.bars = list(compile_bars(self.segments, section_marks, grid, self.chord_table, bar_offset=-1))
+
+        self.timeline_index = TimelineIndex(self.timeline, grid)
+        self.segment_index = IntervalIndex(self.segments, "start_bar", "end_bar")
+
+    @cached_property
+    def beats(self):
+        # שורות beats ל-layout=rows; עם bpm_override – עותק מוקטן, נבנה רק כשמישהו מבקש
+        if self.scale is None or not self._beats:
+            return self._beats
+        return scale_rows(self._beats, "time", self.grid.times)
+
+    def size(self):
+        return estimate_size(self.bars) + self.timeline_index.size() + self.segment_index.size()
+
+    def page(self, start, stop):
+        # תיבות [start, stop) ב-0-based – הכל דרך אינדקסים, העלות לפי גודל העמוד
+        stop = min(stop, len(self.bars))
+        start = min(start, stop)
+
+        # beats: מה-beat הראשון של start עד ה-beat הראשון של stop
+        first_beat = self.grid.bar_first_beat.get(start)
+        if first_beat is None or start == stop:
+            first_beat = end_beat = 0
+        else:
+            end_beat = self.grid.bar_first_beat.get(stop, len(self.grid))
+
+        if first_beat < end_beat:
+            t0 = self.grid.times[first_beat]
+            t1 = self.grid.times[end_beat] if end_beat < len(self.grid) else float("inf")
+            timeline = self.timeline_index.overlapping(t0, t1)
+        else:
+            timeline = []
+
+        return BarPage(
+            start,
+            stop,
+            self.bars[start:stop],
+            self.segment_index.between(start + 1, stop) if start < stop else [],
+            timeline,
+            first_beat,
+            end_beat
+        )
+
+
+BarPage = namedtuple("BarPage", "start stop bars segments timeline first_beat end_beat")
+
+
+def chart_ir(job_id, analysis, bpm_override=None, complete=True):
+    # משותף לכל הבקשות של אותו (job, bpm_override) – לקריאה בלבד
+    cache_key = (job_id, "chart", bpm_override)
+    ir = result_cache.get(cache_key)
+    if ir is None:
+        ir = ChartIR(job_id, analysis, bpm_override, complete)
+        # IR של תוצאה חלקית לא נשמר – כמו התוצאה עצמה, נבנה מחדש כש-beats/sections יחזרו
+        if complete:
+            result_cache.put(cache_key, ir, ir.size())
+    return ir
+
+
+def load_chart(job_id, bpm_override=None):
+    # מחזיר (ChartIR, None, 200) או (None, payload של שגיאה, http code)
+
+    job_id, ticket = resolve_ticket(job_id)
+
+    if job_id is None:
+        if ticket["status"] == "UNKNOWN":
+            return None, ticket, 404
+        if ticket["status"] == "FAILED":
+            return None, ticket, 502
+        return None, {"error": "Processing"}, 400
+
+    try:
+        analysis, complete = fetch_analysis(job_id)
+    except requests.RequestException as e:
+        return None, {"error": "Failed to reach music.ai", "details": str(e)}, 502
+
+    if analysis[0] is None:
+        return None, {"error": "Processing"}, 400
+
+    return chart_ir(job_id, analysis, bpm_override, complete), None, 200
+
+
+# ---------------------------------------------------
+# CHORDPRO – טקסט: תיבות מופרדות ב-|, אקורדים בסוגריים מרובעים
+# ---------------------------------------------------
+CHORDPRO_BARS_PER_LINE = 4
+
+
+@metrics.timed("chordpro")
+def render_chordpro(ir):
+    lines = []
+
+    for directive, value in (("title", ir.metadata["title"]), ("artist", ir.metadata["artist"]), ("key", ir.key)):
+        if value:
+            lines.append(f"{{{directive}: {value}}}")
+
+    if ir.bpm is not None:
+        lines.append(f"{{tempo: {ir.bpm:g}}}")
+
+    row = []
+
+    def flush():
+        if row:
+            lines.append("| " + " | ".join(row) + " |")
+            row.clear()
+
+    previous_meter = None
+
+    for bar in ir.bars:
+        if bar.sections:
+            flush()
+            lines.extend(f"{{comment: {label}}}" for label in bar.sections)
+
+        if (bar.beats, bar.beat_type) != previous_meter:
+            flush()
+            lines.append(f"{{time: {bar.beats}/{bar.beat_type}}}")
+            previous_meter = bar.beats, bar.beat_type
+
+        # תיבה בלי אקורד חדש – האקורד הקודם ממשיך
+        row.append(" ".join(f"[{e.spelled}]" for e in bar.events) or "/")
+
+        if len(row) == CHORDPRO_BARS_PER_LINE:
+            flush()
+
+    flush()
+
+    return "\n".join(lines) + "\n"
 
-        if upload_res.status_code != 200:
-            return jsonify({
-                "error": "Failed to get upload URL from music.ai",
-                "status_code": upload_res.status_code,
-                "response": upload_res.text
-            }), 502
 
-        upload_data = upload_res.json()
+# ---------------------------------------------------
+# MIDI – Standard MIDI File (format 0) עם ערוץ אקורדים אחד
+# ---------------------------------------------------
+MIDI_DIVISION = 480
+MIDI_ROOT_NOTE = 48  # C3
+MIDI_VELOCITY = 80
+
+PITCH_CLASSES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+KIND_INTERVALS = {
+    "major": (0, 4, 7),
+    "minor": (0, 3, 7),
+    "augmented": (0, 4, 8),
+    "diminished": (0, 3, 6),
+    "dominant": (0, 4, 7, 10),
+    "major-seventh": (0, 4, 7, 11),
+    "minor-seventh": (0, 3, 7, 10),
+    "half-diminished": (0, 3, 6, 10),
+    "suspended-second": (0, 2, 7),
+    "suspended-fourth": (0, 5, 7),
+}
+
+DEGREE_SEMITONES = {"5": 7, "9": 14, "11": 17, "13": 21}
+
+
+def pitch_class(note):
+    # "F#" / "Bb" / "E" → 0..11, או None אם זה לא שם של תו
+    if not note or note[0] not in PITCH_CLASSES:
+        return None
+    alter = {"#": 1, "b": -1}.get(note[1:2], 0)
+    return (PITCH_CLASSES[note[0]] + alter) % 12
 
-        upload_url = upload_data.get("uploadUrl")
-        download_url = upload_data.get("downloadUrl")
 
-        if not upload_url or not download_url:
-            return jsonify({
-                "error": "music.ai upload response missing URLs",
-                "response": upload_data
-            }), 502
+def chord_pitches(harmony):
+    step, alter, kind, degrees, bass_note, _ = harmony
 
-        put_res = requests.put(
-            upload_url,
-            data=file.read(),
-            headers={"Content-Type": file.content_type}
-        )
+    intervals = list(KIND_INTERVALS.get(kind, KIND_INTERVALS["major"]))
 
-        if put_res.status_code not in (200, 201):
-            return jsonify({
-                "error": "Failed to upload file to music.ai storage",
-                "status_code": put_res.status_code,
-                "response": put_res.text
-            }), 502
+    for value, dtype, alter_val in degrees:
+        base = DEGREE_SEMITONES.get(value)
+        if base is None:
+            continue
+        shifted = base + int(alter_val or 0)
+        if dtype == "alter" and base in intervals:
+            intervals[intervals.index(base)] = shifted
+        elif shifted not in intervals:
+            intervals.append(shifted)
 
-        params = {"Input 1": download_url}
+    root = MIDI_ROOT_NOTE + (PITCH_CLASSES[step] + (alter or 0)) % 12
+    pitches = sorted({root + i for i in intervals})
 
-        if manual_bpm:
-            params["manual_bpm"] = manual_bpm
-
-        job_res = requests.post(
-            "https://api.music.ai/api/job",
-            headers={
-                "accept": "application/json",
-                "Content-Type": "application/json",
-                "Authorization": API_KEY
-            },
-            json={
-                "name": file.filename,
-                "workflow": WORKFLOW,
-                "params": params
-            }
-        )
+    # בס אוקטבה מתחת לשורש
+    bass = pitch_class(bass_note)
+    if bass is not None:
+        pitches.insert(0, MIDI_ROOT_NOTE - 12 + bass)
 
-        if job_res.status_code != 200:
-            return jsonify({
-                "error": "Failed to create job in music.ai",
-                "status_code": job_res.status_code,
-                "response": job_res.text
-            }), 502
+    return pitches
 
-        job_data = job_res.json()
 
-        return jsonify({"job_id": job_data.get("id")})
+def midi_varlen(value):
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(out)
 
-    except Exception as e:
-        return jsonify({"error": "Unexpected server error", "details": str(e)}), 500
 
+def midi_meta(kind, data):
+    return bytes((0xFF, kind)) + midi_varlen(len(data)) + data
 
-# ---------------------------------------------------
-# FETCH ANALYSIS
-# ---------------------------------------------------
-def fetch_analysis(job_id):
 
-    status_res = requests.get(
-        f"https://api.music.ai/api/job/{job_id}",
-        headers={"Authorization": API_KEY}
-    )
+@metrics.timed("midi")
+def render_midi(ir):
+    # (tick, סדר, bytes) – באותו tick: meta, אחר כך note-off ואז note-on
+    events = [(0, 0, midi_meta(0x03, b"Chords"))]
 
-    status_data = status_res.json()
+    if ir.bpm:
+        tempo = min(round(60000000 / ir.bpm), 0xFFFFFF)
+        events.append((0, 0, midi_meta(0x51, tempo.to_bytes(3, "big"))))
 
-    if status_data["status"] != "SUCCEEDED":
-        return None, None, None, None, None, None, None, None, None, None, status_data["status"]
+    tick = 0
+    previous_meter = None
 
-    result = status_data["result"]
+    for bar in ir.bars:
+        ticks_per_beat = MIDI_DIVISION * 4 // bar.beat_type
 
-    chords_url = result.get("chords") or result.get("Chords")
-    beats_url = result.get("Beats") or result.get("beats")
-    sections_url = result.get("Sections") or result.get("sections")
+        if (bar.beats, bar.beat_type) != previous_meter:
+            denominator = bar.beat_type.bit_length() - 1
+            events.append((tick, 0, midi_meta(0x58, bytes((bar.beats, denominator, 24, 8)))))
+            previous_meter = bar.beats, bar.beat_type
 
-    detected_bpm = result.get("Bpm") or result.get("bpm")
-    manual_bpm = result.get("manual_bpm") or None
-    root_key = result.get("root key") or result.get("root_key")
-    title = result.get("Title") or result.get("title")
-    artist = result.get("Artist") or result.get("artist")
-    isrc = result.get("ISRC") or result.get("isrc")
-    language = result.get("Language") or result.get("language")
+        for label in bar.sections:
+            events.append((tick, 0, midi_meta(0x06, label.encode("utf-8"))))
 
-    chords_json = requests.get(chords_url).json()
+        for event in bar.events:
+            if not event.harmony or event.duration <= 0:
+                continue
 
-    if isinstance(chords_json, dict):
-        chords = chords_json.get("chords", chords_json)
-    else:
-        chords = chords_json
+            start = tick + round((event.beat - 1) * ticks_per_beat)
+            end = start + round(event.duration * ticks_per_beat)
+
+            for pitch in chord_pitches(event.harmony):
+                events.append((start, 2, bytes((0x90, pitch, MIDI_VELOCITY))))
+                events.append((end, 1, bytes((0x80, pitch, 0))))
+
+        tick += bar.beats * ticks_per_beat
 
-    beats = requests.get(beats_url).json() if beats_url else None
-    sections = requests.get(sections_url).json() if sections_url else None
+    events.sort(key=lambda e: (e[0], e[1]))
 
-    return chords, sections, beats, detected_bpm, manual_bpm, root_key, title, artist, isrc, language, "SUCCEEDED"
+    track = bytearray()
+    previous_tick = 0
+    for event_tick, _, data in events:
+        track += midi_varlen(event_tick - previous_tick) + data
+        previous_tick = event_tick
+
+    track += midi_varlen(max(tick - previous_tick, 0)) + midi_meta(0x2F, b"")
+
+    header = b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + MIDI_DIVISION.to_bytes(2, "big")
+
+    return header + b"MTrk" + len(track).to_bytes(4, "big") + bytes(track)
 
 
 # ---------------------------------------------------
 # STATUS ROUTE
 # ---------------------------------------------------
-@app.route("/status/<job_id>")
-def status(job_id):
+BARS_RE = re.compile(r"^(\d+)(?:-(\d+))?$")
 
-    chords, sections, beats, detected_bpm, manual_bpm, root_key, title, artist, isrc, language, state = fetch_analysis(job_id)
 
-    if chords is None:
-        return jsonify({"status": state})
+def parse_bar_range(args):
+    # bars=start-end (1-based, כולל) או page/limit → (start, stop) 0-based; בלי – None
+    bars = args.get("bars")
+    page = args.get("page")
+    limit = args.get("limit")
 
-    if manual_bpm:
-        beats, chords = apply_bpm_scaling(beats, chords, detected_bpm, manual_bpm)
-        bpm = float(manual_bpm)
-    else:
-        bpm = float(detected_bpm) if detected_bpm else None
+    if bars:
+        if page or limit:
+            raise ValueError("Use either bars or page/limit, not both")
+
+        match = BARS_RE.match(str(bars).strip())
+        if not match:
+            raise ValueError("bars must be start-end (1-based, inclusive)")
+
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if first < 1 or last < first:
+            raise ValueError("bars must be start-end (1-based, inclusive)")
+
+        return first - 1, last
+
+    if page or limit:
+        try:
+            page = int(page or 1)
+            limit = int(limit or BARS_PAGE_SIZE)
+        except ValueError:
+            raise ValueError("page and limit must be integers")
+
+        if page < 1 or not 1 <= limit <= BARS_PAGE_MAX:
+            raise ValueError(f"page must be >= 1 and limit between 1 and {BARS_PAGE_MAX}")
+
+        return (page - 1) * limit, page * limit
+
+    return None
+
+
+def parse_status_options(args):
+    # ValueError עם הודעה ללקוח אם פרמטר לא תקין
+    try:
+        bpm_override = parse_bpm_override(args.get("bpm_override"))
+    except ValueError:
+        raise ValueError("bpm_override must be a positive number")
+
+    layout = args.get("layout", "rows")
+    if layout not in ("rows", "columnar"):
+        raise ValueError("layout must be 'rows' or 'columnar'")
+
+    return {"bpm_override": bpm_override, "layout": layout, "bars": parse_bar_range(args)}
+
+
+def build_status_payload(job_id, options=None):
+    # מחזיר (payload, http code, complete) – משותף ל-/status, ל-long-poll ול-SSE
+    # complete=False – התשובה נבנתה מתוצאה חלקית ואסור לסמן אותה כסופית
+    options = options or {}
+
+    # ticket של /analyze?async=1 – עד שה-job נוצר מחזירים את מצב ה-ticket
+    ticket_id = job_id if is_ticket(job_id) else None
+    job_id, ticket = resolve_ticket(job_id)
+
+    if job_id is None:
+        code = 404 if ticket["status"] == "UNKNOWN" else 200
+        return dict(ticket, ticket_id=ticket_id), code, True
+
+    ticket_fields = {"ticket_id": ticket_id, "job_id": job_id} if ticket_id else {}
+
+    try:
+        analysis, complete = fetch_analysis(job_id)
+    except requests.RequestException as e:
+        return {"error": "Failed to reach music.ai", "details": str(e)}, 502, True
+
+    if analysis[0] is None:
+        return dict(ticket_fields, status=analysis[-1]), 200, True
 
-    segments = build_segments(chords)
-    timeline_segments = build_timeline_segments(chords)
+    ir = chart_ir(job_id, analysis, options.get("bpm_override"), complete)
 
-    beats_in_this_bar, beat_type = detect_time_signature(beats)
+    response = render_status_json(ir, options.get("layout") == "columnar", options.get("bars"))
+    response.update(ticket_fields)
+
+    return response, 200, ir.complete
+
+
+@metrics.timed("status_json")
+def render_status_json(ir, columnar=False, bar_range=None):
+    # bar_range – (start, stop) 0-based: רק ה-segments / beats / אקורדים של העמוד
+    if bar_range is not None:
+        page = ir.page(*bar_range)
+        segments = page.segments
+        timeline = page.timeline
+        beat_span = page.first_beat, page.end_beat
+    else:
+        page = None
+        segments = ir.segments
+        timeline = ir.timeline
+        beat_span = None
+
+    if columnar:
+        timeline_payload = timeline_columns(timeline)
+        beats_payload = beat_columns(ir.grid, *beat_span) if beat_span else beat_columns(ir.grid)
+    else:
+        timeline_payload = timeline
+        beats_payload = (ir.beats or [])[slice(*beat_span)] if beat_span else ir.beats
+
+    beats_in_this_bar, beat_type = ir.meter
 
     response = {
         "status": "SUCCEEDED",
         "chart": segments,
-        "timeline_chords": timeline_segments,
-        "beats": beats,
+        "timeline_chords": timeline_payload,
+        "chord_table": chord_table_json(ir.chord_table),
+        "beats": beats_payload,
         "time_signature": {
             "beats_in_this_bar": beats_in_this_bar,
             "beat_type": beat_type
         },
-        "bpm": bpm,
-        "key": root_key,
-        "title": title,
-        "artist": artist,
-        "isrc": isrc,
-        "language": language
+        "bpm": ir.bpm,
+        "key": ir.key,
+        "title": ir.metadata["title"],
+        "artist": ir.metadata["artist"],
+        "isrc": ir.metadata["isrc"],
+        "language": ir.metadata["language"]
     }
 
-    if sections is not None:
-        response["sections"] = sections
+    if columnar:
+        response["layout"] = "columnar"
+
+    if page is not None:
+        response["bars"] = bar_page_json(ir, page)
+
+    if ir.sections is not None:
+        response["sections"] = ir.sections
+
+    return response
+
+
+def bar_page_json(ir, page):
+    # מספרי תיבות 1-based כמו ב-chart; end < start = עמוד ריק (אחרי סוף השיר)
+    return {"start": page.start + 1, "end": page.stop, "total": len(ir.bars)}
+
+
+def is_final_payload(payload, code):
+    return code != 200 or "error" in payload or payload.get("status") in TERMINAL_STATES
+
+
+def parse_wait(args):
+    # ?wait=<seconds> – 0 עד LONGPOLL_MAX_WAIT; nan / inf / שלילי → ValueError
+    try:
+        wait_seconds = float(args.get("wait", 0))
+    except ValueError:
+        raise ValueError("wait must be a number of seconds")
+
+    if not math.isfinite(wait_seconds) or wait_seconds < 0:
+        raise ValueError("wait must be a non-negative number of seconds")
+
+    return min(wait_seconds, LONGPOLL_MAX_WAIT)
+
+
+class StatusWatch:
+    # צופה אחד (long-poll / SSE): ה-payload נבנה מחדש רק כשה-poller רושם שינוי במצב של ה-job שלו,
+    # כך שצופים על job שלא השתנה לא פונים ל-music.ai
+
+    def __init__(self, job_id, options):
+        self.job_id = job_id
+        self.options = options
+        self.refresh()
+
+    def refresh(self):
+        # ticket → ה-job שנוצר ממנו (None עד שנוצר). version נקרא לפני ה-build –
+        # שינוי שקורה בזמן ה-build מעיר את ה-wait הבא מיד
+        self.watched, _ = resolve_ticket(self.job_id)
+        self.version = job_poller.version(self.watched) if self.watched else 0
+        self.payload, self.code, self.complete = build_status_payload(self.job_id, self.options)
+
+    def wait(self, timeout):
+        # True אם ה-payload נבנה מחדש
+        if self.watched is None:
+            # ticket בלי job – מצבו בקובץ (אולי של worker אחר), אין התראה: בודקים כל שנייה
+            time.sleep(min(timeout, 1.0))
+        elif not job_poller.wait_for_change(self.watched, self.version, timeout):
+            # job שה-poller לא עוקב אחריו (POLL_MAX_JOBS מלא) – אף אחד לא יעיר, בודקים בעצמנו
+            if job_poller.is_tracked(self.watched):
+                return False
+
+        self.refresh()
+        return True
+
+
+@app.route("/status/<job_id>")
+def status(job_id):
+
+    try:
+        options = parse_status_options(request.args)
+        # long-poll: ?wait=<seconds>[&since=<state>] – מחזיקים את הבקשה עד שהמצב משתנה
+        wait_seconds = parse_wait(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    etag = render_etag("status", job_id, options)
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    watch = StatusWatch(job_id, options)
 
-    return jsonify(response)
+    known_state = request.args.get("since") or watch.payload.get("status")
+    deadline = time.monotonic() + wait_seconds
+
+    while not is_final_payload(watch.payload, watch.code) and watch.payload.get("status") == known_state:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        watch.wait(remaining)
+
+    payload, code, complete = watch.payload, watch.code, watch.complete
+
+    response = jsonify(payload)
+    response.status_code = code
+
+    if code == 200 and payload.get("status") in TERMINAL_STATES and complete:
+        mark_immutable(response, etag)
+
+    return response
+
+
+# ---------------------------------------------------
+# STATUS EVENTS (SSE)
+# ---------------------------------------------------
+# כל צופה מחכה על ה-Condition של ה-job שלו ב-poller, שהוא היחיד שפונה ל-music.ai.
+# ב-gunicorn ה-worker הוא gevent (gunicorn.conf.py) – כל צופה הוא greenlet ולא thread.
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'), default=json_default)}\n\n"
+
+
+@app.route("/status/<job_id>/events")
+def status_events(job_id):
+
+    try:
+        options = parse_status_options(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def stream():
+        watch = StatusWatch(job_id, options)
+        last_state = None
+        last_sent = time.monotonic()
+        deadline = last_sent + SSE_MAX_DURATION
+
+        while True:
+            payload, code = watch.payload, watch.code
+            state = payload.get("status")
+
+            if code != 200 or "error" in payload:
+                yield sse_event("error", payload)
+                return
+
+            if state == "SUCCEEDED":
+                yield sse_event("result", payload)
+                return
+
+            if state != last_state:
+                yield sse_event("status", payload)
+                last_state = state
+                last_sent = time.monotonic()
+
+            if state in TERMINAL_STATES:
+                return
+
+            now = time.monotonic()
+            if now >= deadline:
+                return
+
+            if now - last_sent >= SSE_HEARTBEAT:
+                yield ": keep-alive\n\n"
+                last_sent = now
+
+            watch.wait(min(SSE_HEARTBEAT, deadline - now))
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 # ---------------------------------------------------
 # MUSICXML ROUTE
 # ---------------------------------------------------
+def musicxml_chunks(ir, bar_range=None):
+    # עמוד = פרטיטורה עצמאית: בתיבה הראשונה שלו render_musicxml כותב divisions, key, time ו-tempo
+    bars = ir.bars[slice(*bar_range)] if bar_range else ir.bars
+
+    return metrics.timed_stream("musicxml", render_musicxml(bars, ir.bpm, ir.key_fifths, ir.key_mode))
+
+
+def build_musicxml(job_id, bpm_override=None, bar_range=None):
+    # מחזיר (generator של chunks, None, 200) או (None, payload של שגיאה, http code)
+    ir, error, code = load_chart(job_id, bpm_override)
+    if ir is None:
+        return None, error, code
+
+    return musicxml_chunks(ir, bar_range), None, 200
+
+
 @app.route("/musicxml/<job_id>")
 def musicxml(job_id):
 
-    chords, sections, beats, detected_bpm, manual_bpm, root_key, title, artist, isrc, language, state = fetch_analysis(job_id)
+    output_format = request.args.get("format", "musicxml")
+    if output_format not in ("musicxml", "mxl"):
+        return jsonify({"error": "format must be 'musicxml' or 'mxl'"}), 400
 
-    if chords is None:
-        return jsonify({"error": "Processing"}), 400
+    try:
+        bpm_override = parse_bpm_override(request.args.get("bpm_override"))
+    except ValueError:
+        return jsonify({"error": "bpm_override must be a positive number"}), 400
 
-    if manual_bpm:
-        beats, chords = apply_bpm_scaling(beats, chords, detected_bpm, manual_bpm)
-        bpm = float(manual_bpm)
+    try:
+        bar_range = parse_bar_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    etag = render_etag("musicxml", job_id, {"bpm_override": bpm_override, "format": output_format, "bars": bar_range})
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    ir, error, code = load_chart(job_id, bpm_override)
+    if ir is None:
+        return jsonify(error), code
+
+    xml_chunks = musicxml_chunks(ir, bar_range)
+
+    if output_format == "mxl":
+        response = Response(
+            build_mxl(xml_chunks),
+            mimetype=MXL_MIMETYPE,
+            headers={"Content-Disposition": "attachment; filename=chords.mxl"}
+        )
     else:
-        bpm = float(detected_bpm) if detected_bpm else None
+        response = Response(
+            xml_chunks,
+            mimetype="application/xml",
+            headers={"Content-Disposition": "attachment; filename=chords.musicxml"}
+        )
+
+    if ir.complete:
+        mark_immutable(response, etag)
+
+    return response
+
+
+# ---------------------------------------------------
+# CHORDPRO / MIDI ROUTES – רק render מעל ה-ChartIR
+# ---------------------------------------------------
+def chart_file_response(kind, job_id, render, mimetype, filename):
+
+    try:
+        bpm_override = parse_bpm_override(request.args.get("bpm_override"))
+    except ValueError:
+        return jsonify({"error": "bpm_override must be a positive number"}), 400
+
+    etag = render_etag(kind, job_id, {"bpm_override": bpm_override})
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    ir, error, code = load_chart(job_id, bpm_override)
+    if ir is None:
+        return jsonify(error), code
+
+    response = Response(
+        render(ir),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+    if ir.complete:
+        mark_immutable(response, etag)
+
+    return response
+
+
+@app.route("/chordpro/<job_id>")
+def chordpro(job_id):
+    return chart_file_response("chordpro", job_id, render_chordpro, "text/plain", "chords.cho")
+
+
+@app.route("/midi/<job_id>")
+def midi(job_id):
+    return chart_file_response("midi", job_id, render_midi, "audio/midi", "chords.mid")
+
+
+# ---------------------------------------------------
+# TIMELINE ROUTE – /timeline/<job_id>?from=&to=
+# ---------------------------------------------------
+def parse_time_range(args):
+    try:
+        t0 = float(args["from"])
+        t1 = float(args.get("to", t0))
+    except KeyError:
+        raise ValueError("from is required")
+    except ValueError:
+        raise ValueError("from and to must be numbers of seconds")
+
+    if t0 != t0 or t1 != t1 or t1 < t0:
+        raise ValueError("to must not be earlier than from")
+
+    return t0, t1
+
+
+@app.route("/timeline/<job_id>")
+def timeline(job_id):
+
+    try:
+        t0, t1 = parse_time_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        bpm_override = parse_bpm_override(request.args.get("bpm_override"))
+    except ValueError:
+        return jsonify({"error": "bpm_override must be a positive number"}), 400
+
+    etag = render_etag("timeline", job_id, {"from": t0, "to": t1, "bpm_override": bpm_override})
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    ir, error, code = load_chart(job_id, bpm_override)
+    if ir is None:
+        return jsonify(error), code
+
+    response = jsonify({
+        "from": t0,
+        "to": t1,
+        "chords": ir.timeline_index.query(t0, t1)
+    })
+
+    if ir.complete:
+        mark_immutable(response, etag)
+
+    return response
+
+
+# ---------------------------------------------------
+# BATCH ROUTES – הרבה jobs בבקשה אחת, תוצאות נשלחות לפי סדר הסיום
+# ---------------------------------------------------
+# pool נפרד מ-artifact_pool (ש-fetch_analysis עצמו משתמש בו) – אחרת אפשר להיתקע
+batch_pool = ThreadPoolExecutor(
+    max_workers=BATCH_CONCURRENCY,
+    thread_name_prefix="batch"
+)
+
+
+def parse_batch_request():
+    # {"job_ids": [...], ...options} ב-JSON, או job_ids=a,b,c ב-query / form
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = request.values.to_dict()
+        body["job_ids"] = [j for j in (body.get("job_ids") or "").split(",") if j]
+
+    job_ids = body.get("job_ids")
+    if not isinstance(job_ids, list) or not job_ids or not all(isinstance(j, str) and j for j in job_ids):
+        raise ValueError("job_ids must be a non-empty list of job ids")
+
+    if len(job_ids) > BATCH_MAX_JOBS:
+        raise ValueError(f"At most {BATCH_MAX_JOBS} job ids per batch")
+
+    # כל job פעם אחת, לפי סדר הבקשה
+    return list(dict.fromkeys(job_ids)), body
+
+
+def fan_out(fn, job_ids, *args):
+    # מריץ fn(job_id, *args) במקביל ומחזיר (job_id, תוצאה) לפי סדר הסיום
+    futures = {batch_pool.submit(fn, job_id, *args): job_id for job_id in job_ids}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # הלקוח התנתק באמצע – לא מריצים jobs שעוד לא התחילו
+        for future in futures:
+            future.cancel()
+
+
+def batch_status_entry(job_id, options):
+    try:
+        payload, code, _ = build_status_payload(job_id, options)
+    except Exception as e:
+        log.exception("batch status of %s failed", job_id)
+        payload, code = {"error": "Unexpected server error", "details": str(e)}, 500
+    return dict(payload, job_id=payload.get("job_id", job_id), code=code)
+
+
+@app.route("/status/batch", methods=["POST"])
+def status_batch():
+
+    try:
+        job_ids, body = parse_batch_request()
+        options = parse_status_options(body)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def stream():
+        # שורת JSON לכל job (NDJSON) ברגע שהוא מוכן
+        for job_id, entry in fan_out(batch_status_entry, job_ids, options):
+            yield json.dumps(dict(entry, requested_id=job_id), separators=(",", ":"), default=json_default) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson")
+
+
+class ZipStreamSink:
+    # "קובץ" בלי seek ש-ZipFile כותב אליו; כל מה שנכתב נשלף ונשלח ללקוח
+    def __init__(self):
+        self._chunks = []
 
-    # בונים segments ישירות מה-JSON, בלי שום שינוי ל-bar/beat
-    segments = build_segments(chords)
-    # Convert 1-based bars (music.ai) to 0-based (internal)
-    if segments:
-        for s in segments:
-            s["start_bar"] -= 1
-            s["end_bar"] -= 1
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
 
-    mapped_sections = map_sections_to_bars(sections, beats) if sections else None
+    def flush(self):
+        pass
 
-    xml_data = chords_to_musicxml(segments, mapped_sections, bpm, beats, key_str=root_key)
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def batch_musicxml_entry(job_id, bpm_override):
+    try:
+        xml_chunks, error, code = build_musicxml(job_id, bpm_override)
+        if xml_chunks is None:
+            return None, dict(error, code=code)
+        return b"".join(xml_chunks), None
+    except Exception as e:
+        log.exception("batch musicxml of %s failed", job_id)
+        return None, {"error": "Unexpected server error", "details": str(e), "code": 500}
+
+
+@app.route("/musicxml/batch", methods=["POST"])
+def musicxml_batch():
+
+    try:
+        job_ids, body = parse_batch_request()
+        bpm_override = parse_bpm_override(body.get("bpm_override"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def stream():
+        sink = ZipStreamSink()
+        errors = {}
+
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+            for job_id, (xml_data, error) in fan_out(batch_musicxml_entry, job_ids, bpm_override):
+                if error is not None:
+                    errors[job_id] = error
+                    continue
+
+                zf.writestr(f"{job_id}.musicxml", xml_data)
+                yield sink.drain()
+
+            # job שלא הצליח (עדיין בעיבוד / נכשל) מופיע ב-errors.json
+            if errors:
+                zf.writestr("errors.json", json.dumps(errors, indent=2))
+
+        yield sink.drain()
+
+    return Response(
+        stream(),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=charts.zip"}
+    )
+
+
+# ---------------------------------------------------
+# METRICS ROUTE – Prometheus text, מאוחד מכל ה-workers
+# ---------------------------------------------------
+def cache_metrics():
+    chord_info = parse_chord_symbol.cache_info()
+    for cache, hits, misses in (
+        ("result", result_cache.hits, result_cache.misses),
+        ("chord", chord_info.hits, chord_info.misses),
+        ("analysis_store", analysis_store.hits, analysis_store.misses),
+    ):
+        labels = (("cache", cache),)
+        yield "cache_hits_total", labels, hits
+        yield "cache_misses_total", labels, misses
+
+
+metrics.collectors.append(cache_metrics)
+
+
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# ---------------------------------------------------
+# PROFILING – cProfile של בקשה שלמה (כולל streaming), לטבעת קבצים בדיסק
+# ---------------------------------------------------
+PROFILE_ID_RE = re.compile(r"^\d+-[0-9a-f]{8}$")
+PROFILE_HEADER = "X-Profile-Token"
+
+
+def valid_profile_token(value):
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(value or "", PROFILE_TOKEN)
+
+
+class ProfileRing:
+    # <id>.prof (pstats) + <id>.json (metadata); רק PROFILE_MAX_FILES האחרונים נשמרים
+
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def path(self, profile_id, ext):
+        return os.path.join(self.directory, f"{profile_id}.{ext}")
+
+    def save(self, profiler, meta):
+        profile_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        meta = dict(meta, id=profile_id, created=time.time())
+
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                profiler.dump_stats(self.path(profile_id, "prof"))
+                with open(self.path(profile_id, "json"), "w") as f:
+                    json.dump(meta, f)
+                self._trim()
+            except OSError as e:
+                log.warning("saving profile failed: %s", e)
+
+    def _trim(self):
+        # ה-id מתחיל ב-timestamp – מיון לפי שם = מיון לפי זמן
+        ids = self.ids()
+        for profile_id in ids[:-self.max_files] if len(ids) > self.max_files else ():
+            for ext in ("prof", "json"):
+                try:
+                    os.remove(self.path(profile_id, ext))
+                except FileNotFoundError:
+                    pass
+
+    def ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith(".json") and PROFILE_ID_RE.match(name[:-5]))
+
+    def list(self):
+        entries = []
+        for profile_id in reversed(self.ids()):
+            try:
+                with open(self.path(profile_id, "json")) as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return entries
+
+
+profile_ring = ProfileRing(PROFILE_DIR, PROFILE_MAX_FILES)
+
+
+class ProfiledResponse:
+    # ה-profiler פעיל רק בזמן שה-app מייצר chunks, לא בזמן ההמתנה ללקוח.
+    # release – משחרר את נעילת ה-profiling של התהליך בסוף (close)
+
+    def __init__(self, profiler, app_iter, meta, release):
+        self.profiler = profiler
+        self.app_iter = app_iter
+        self.meta = meta
+        self.release = release
+        self.size = 0
+
+    def __iter__(self):
+        chunks = iter(self.app_iter)
+        while True:
+            self.profiler.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.profiler.disable()
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, "close", None)
+            if close is not None:
+                self.profiler.enable()
+                try:
+                    close()
+                finally:
+                    self.profiler.disable()
+        finally:
+            try:
+                self.meta["seconds"] = round(time.perf_counter() - self.meta.pop("started"), 6)
+                self.meta["payload_bytes"] = self.size
+                profile_ring.save(self.profiler, self.meta)
+            finally:
+                self.release()
+
+
+class ProfilingMiddleware:
+    # מותקן רק אם profiling מוגדר; כשהוא כבוי – אין שום עלות לבקשה.
+    # פרופיל אחד בכל פעם לכל תהליך: ה-hook של cProfile הוא לכל OS thread, וב-gevent כל
+    # ה-greenlets חולקים אותו – שני פרופילים חופפים דורסים זה את זה. בקשה שמגיעה בזמן
+    # פרופיל פעיל פשוט לא נמדדת (גם עם header). עדיין, greenlets אחרים שרצים בזמן
+    # שהבקשה הנמדדת מחכה ל-I/O נכנסים לפרופיל שלה
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._active = threading.Lock()
+
+    def trigger(self, environ):
+        # נעילת ה-profiling נתפסת כאן (בלי לחכות) – הקורא משחרר אותה בסוף הפרופיל
+        if environ.get("PATH_INFO", "").startswith("/profiles"):
+            return None
+        if valid_profile_token(environ.get("HTTP_X_PROFILE_TOKEN")):
+            trigger = "header"
+        elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            trigger = "sample"
+        else:
+            return None
+
+        if not self._active.acquire(blocking=False):
+            log.info("profile of %s skipped: another profile is active", environ.get("PATH_INFO"))
+            return None
+        return trigger
+
+    def __call__(self, environ, start_response):
+        trigger = self.trigger(environ)
+        if trigger is None:
+            return self.wsgi_app(environ, start_response)
+
+        meta = {
+            "trigger": trigger,
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "query": environ.get("QUERY_STRING"),
+            "job_id": profiled_job_id(environ),
+            "pid": os.getpid(),
+            "started": time.perf_counter()
+        }
+
+        def profiled_start_response(status, headers, exc_info=None):
+            meta["status"] = int(status.split(" ", 1)[0])
+            return start_response(status, headers, exc_info)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            app_iter = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:
+            self._active.release()
+            raise
+        finally:
+            profiler.disable()
+
+        return ProfiledResponse(profiler, app_iter, meta, self._active.release)
+
+
+def profiled_job_id(environ):
+    try:
+        _, args = app.url_map.bind_to_environ(environ).match()
+    except Exception:
+        return None
+    return args.get("job_id")
+
+
+if PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+
+
+def operator_denied():
+    # None אם ה-header תקין; אחרת תשובת שגיאה
+    if not PROFILE_TOKEN:
+        return jsonify({"error": "Profiling routes are disabled (PROFILE_TOKEN is not set)"}), 404
+    if not valid_profile_token(request.headers.get(PROFILE_HEADER)):
+        return jsonify({"error": f"Missing or invalid {PROFILE_HEADER} header"}), 403
+    return None
+
+
+@app.route("/profiles")
+def list_profiles():
+    denied = operator_denied()
+    if denied:
+        return denied
+
+    return jsonify({"profiles": profile_ring.list(), "max_files": PROFILE_MAX_FILES})
+
+
+@app.route("/profiles/<profile_id>")
+def download_profile(profile_id):
+    denied = operator_denied()
+    if denied:
+        return denied
+
+    if not PROFILE_ID_RE.match(profile_id):
+        return jsonify({"error": "Unknown profile"}), 404
+
+    path = profile_ring.path(profile_id, "prof")
+    if not os.path.exists(path):
+        return jsonify({"error": "Unknown profile"}), 404
+
+    # ?format=text – סיכום pstats (לפי cumulative) במקום הקובץ הבינארי
+    if request.args.get("format") == "text":
+        try:
+            limit = int(request.args.get("limit", 60))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+
+        out = StringIO()
+        stats = pstats.Stats(path, stream=out)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return Response(out.getvalue(), mimetype="text/plain")
+
+    with open(path, "rb") as f:
+        data = f.read()
 
     return Response(
-        xml_data,
-        mimetype="application/xml",
-        headers={"Content-Disposition": "attachment; filename=chords.musicxml"}
+        data,
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename={profile_id}.prof"}
     )
 
 
@@ -761,8 +3881,20 @@ def home():
         "routes": [
             "/analyze (POST)",
             "/status/<job_id>",
-            "/musicxml/<job_id>"
-        ]
+            "/status/<job_id>/events",
+            "/status/batch (POST)",
+            "/musicxml/<job_id>",
+            "/musicxml/batch (POST)",
+            "/chordpro/<job_id>",
+            "/midi/<job_id>",
+            "/metrics",
+            "/profiles (operator)",
+            "/timeline/<job_id>?from=&to="
+        ],
+        "result_cache": result_cache.stats(),
+        "chord_cache": chord_cache_stats(),
+        "analysis_store": analysis_store.stats(),
+        "polled_jobs": job_poller.tracked()
     })
 
 